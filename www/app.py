@@ -7,19 +7,25 @@ __author__ = 'hpt'
 async web application
 '''
 
-import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import logging
+import asyncio, os, json, time, hashlib, argparse
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from config import configs
+from logs import init_logging
 
 import orm
-from coroweb import add_routes, add_static
+from cache import pages
+import server
+from coroweb import add_routes, add_static, is_public, is_cacheable, current_user
 
-from handlers import cookie2user, COOKIE_NAME
+import sessions
+from handlers import cookie2session, session2user, renew_cookie, COOKIE_NAME
+
+logger = logging.getLogger('app')
 
 '''
 初始化jinja2需要以下几步：
@@ -28,7 +34,7 @@ from handlers import cookie2user, COOKIE_NAME
 3、有了加载器和options参数，传递给Environment类，添加过滤器，完成初始化。
 '''
 def init_jinja2(app, **kw):
-    logging.info('init jinja2...')
+    logger.info('init jinja2...')
     # class Environment(**options)
     # 配置options参数
     options = dict(
@@ -40,14 +46,23 @@ def init_jinja2(app, **kw):
         # 变量的开始、结束标志
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        # 自动加载修改后的模板文件
-        auto_reload = kw.get('auto_reload', True)
+        # 自动加载修改后的模板文件, 每次get_template都会检查模板文件是否修改, 生产环境应关闭
+        auto_reload = kw.get('auto_reload', True),
+        # 异步渲染, 渲染时使用await template.render_async()
+        enable_async = kw.get('enable_async', False)
     )
+    # 编译后的模板字节码缓存到目录, 重启时不必重新编译模板
+    bytecode_cache_dir = kw.get('bytecode_cache_dir', None)
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        # 同步和异步模式编译出的代码不同, 不能共用缓存文件
+        pattern = '__jinja2_%s.async.cache' if options['enable_async'] else '__jinja2_%s.cache'
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache_dir, pattern)
     # 获取模板文件夹路径
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates') # /.../awesome-python3-webapp/www/templates/
-    logging.info('set jinja2 templates path: %s' % path)
+    logger.info('set jinja2 templates path: %s', path)
     # Environment类是jinja2的核心类，用来保存配置、全局对象以及模板文件的路径
     # FileSystemLoader类加载path路径中的模板文件
     env = Environment(loader=FileSystemLoader(path), **options)
@@ -57,6 +72,12 @@ def init_jinja2(app, **kw):
         for name, f in filters.items():
             # filters是Environment类的属性：过滤器字典
             env.filters[name] = f
+    # 启动时加载全部模板, 请求时get_template直接命中Environment中已编译的模板
+    if kw.get('precompile', False):
+        names = env.list_templates(extensions=['html'])
+        for name in names:
+            env.get_template(name)
+        logger.info('precompiled %s templates.', len(names))
      # 所有的一切是为了给app添加__templating__字段
     # 前面将jinja2的环境配置都赋值给env了，这里再把env存入app的dict中，这样app就知道要到哪儿去找模板，怎么解析模板。
     app['__templating__'] = env # app是一个dict-like对象
@@ -88,41 +109,92 @@ web框架正是由一层层middleware的封装，才具备各种完善的功能
 '''
 # 编写用于输出日志的middleware
 # handler是视图函数
+_stats = dict(requests=0)
+
 async def logger_factory(app, handler):
-    async def logger(request):
-        logging.info('logger_factory---Request: %s %s' % (request.method, request.path))
+    async def log_request(request):
+        _stats['requests'] += 1
+        logger.info('logger_factory---Request: %s %s', request.method, request.path)
         # await asyncio.sleep(1)
         return (await handler(request))
-    return logger
+    return log_request
 
 # auth_factory使用async/await 会出现object generator can't be used in 'await' expression错误
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('auth_factory--check user: %s %s' % (request.method, request.path))
-        request.__user__ = None
+        # 静态文件和public路由不需要当前用户
+        if is_public(request):
+            request.__user__ = None
+            return (await handler(request))
+        # 其余请求也只在用到当前用户时(current_user)才解析cookie
         cookie_str = request.cookies.get(COOKIE_NAME)
-        print('auth_factory-----', cookie_str)
-        if cookie_str:
-            user = await cookie2user(cookie_str)
-            print('auth_factory----', user)
-            if user:
-                logging.info('set current user: %s' % user.email)
-                request.__user__ = user
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            logging.info('request not exist or admin is False, switch to signin...')
-            return web.HTTPFound('/signin')
-        return (await handler(request))
+        resolved = []
+        async def load_user():
+            session = await cookie2session(cookie_str) if cookie_str else None
+            if session is None:
+                return None
+            logger.debug('set current user: %s', session['id'])
+            resolved.append(session)
+            return session2user(session)
+        request.__load_user__ = load_user
+        if request.path.startswith('/manage/'):
+            user = await current_user(request)
+            if user is None or not user.admin:
+                logger.info('request not exist or admin is False, switch to signin...')
+                return web.HTTPFound('/signin')
+        r = await handler(request)
+        # 滑动过期: 活跃用户的cookie快过期时换发新cookie, handler自己设置了cookie时不覆盖
+        if resolved and isinstance(r, web.StreamResponse) and COOKIE_NAME not in r.cookies:
+            cookie = renew_cookie(resolved[0])
+            if cookie:
+                r.set_cookie(COOKIE_NAME, cookie, max_age=configs.session.max_age, httponly=True)
+        return r
     return auth
 
+# json序列化无法直接处理的对象: Record行对象按字段转为dict, 其余使用__dict__
+def json_default(o):
+    if isinstance(o, orm.Record):
+        return o._asdict()
+    return o.__dict__
+
+# 整页缓存的middleware, 位于auth_factory之后、response_factory之前, 缓存response_factory构造出的Response
+# 命中时不再访问数据库和渲染模板, 并使用ETag, 客户端已有相同内容时直接返回304
+async def page_cache_factory(app, handler):
+    pages.configure(configs.page_cache.maxsize, configs.page_cache.ttl)
+    async def page_cache(request):
+        if not configs.page_cache.enabled or request.method not in ('GET', 'HEAD') or not is_cacheable(request):
+            return (await handler(request))
+        # 模板中会渲染当前用户, 登录用户的页面不与其他人共享
+        user = None if is_public(request) else (await current_user(request))
+        key = (request.path, request.query_string, '' if user is None else user.id)
+        entry = pages.get(key)
+        if entry is None:
+            r = await handler(request)
+            # 只缓存正常返回且没有设置cookie, 也没有声明no-store(如API错误)的响应
+            if type(r) is not web.Response or r.status != 200 or r.cookies or not isinstance(r.body, bytes) or 'no-store' in r.headers.get('Cache-Control', ''):
+                return r
+            etag = '"%s"' % hashlib.sha1(r.body).hexdigest()
+            entry = (r.body, r.headers.get('Content-Type'), etag)
+            pages.set(key, entry)
+        body, content_type, etag = entry
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+            return web.Response(status=304, headers={'ETag': etag})
+        resp = web.Response(body=body, headers={'ETag': etag})
+        if content_type:
+            resp.headers['Content-Type'] = content_type
+        return resp
+    return page_cache
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                logger.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                logger.debug('request form: %s', request.__data__)
         return (await handler(request))
     return parse_data
 
@@ -135,80 +207,104 @@ async def data_factory(app, handler):
 # 3、response_factory对处理后的对象，经过一系列类型判断，构造出真正的web.Response对象
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('response_factory...')
+        logger.debug('response_factory...')
         r = await handler(request) # 调用RequestHandler.__call__，对参数进行处理
         if isinstance(r, web.StreamResponse): # StreamResponse是所有Response对象的父类
-            print('response "StreamResponse"')
             return r # 无需构造，直接返回
         if isinstance(r, bytes):
-            print('response "bytes"')
             resp = web.Response(body=r) # 继承自StreamResponse，接受body参数，构造HTTP响应内容
             # Response的content_type属性
             resp.content_type = 'application/octet-stream'
-            print('resp =', resp)
             return resp
         if isinstance(r, str):
-            print('response "str"')
             if r.startswith('redirect:'): # 若返回重定向字符串
                 return web.HTTPFound(r[9:]) # 重定向至目标URL
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8' # utf-8编码的text格式
-            print('resp =', resp)
             return resp
         # r为dict对象时
         if isinstance(r, dict):
-            print('response "dict"')
             # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
             template = r.get('__template__')
             if template is None: # 不带模板信息，返回json对象
                 # ensure_ascii：默认True，仅能输出ascii格式数据。故设置为False。  
-                # default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象  
-                # __dict__：以dict形式返回对象属性和值的映射
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                # default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
-                print('resp =', resp)
+                # APIError的结果(带error)不能被缓存
+                if 'error' in r:
+                    resp.headers['Cache-Control'] = 'no-store'
                 return resp
             else: # 带模板信息，渲染模板
                 # app['__templating__']获取已初始化的Environment对象，调用get_template()方法返回Template对象  
                 # 调用Template对象的render()方法，传入r渲染模板，返回unicode格式字符串，将其用utf-8编码
-                r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                r['__user__'] = await current_user(request)
+                env = app['__templating__']
+                if env.is_async:
+                    body = await env.get_template(template).render_async(**r)
+                else:
+                    body = env.get_template(template).render(**r)
+                resp = web.Response(body=body.encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8' # utf-8编码的html格式
-                print('resp =', resp)
                 return resp
         # 返回响应码
         if isinstance(r, int) and r >= 100 and r < 600:
-            print('response "int"')
             return web.Response(status=r)
         # 返回了一组响应代码和原因，如：(200, 'OK'), (404, 'Not Found')
         if isinstance(r, tuple) and len(r) == 2:
-            print('response "tuple"')
             t, m =r
             if isinstance(t, int) and t >= 100 and t < 600:
                 return web.Response(status=r, text=str(m))
         # default:
-        print('response "default"')
         resp = web.Response(body=str(r).encode('utf-8'))
         resp.content_type = 'text/plain;charset=utf-8'
-        print('resp =', resp)
         return resp
     return response
 
-async def init(loop):
+# worker定期向master报告的状态
+def worker_health():
+    return dict(requests=_stats['requests'], sessions=sessions.store.stats())
+
+# sock为多进程模式下从master继承的监听socket, 为None时按configs.server绑定端口
+async def init(loop, sock=None):
     #await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='123456', db='awesome')
     await orm.create_pool(loop=loop, **configs['database']) # 导入config配置文件，连接数据库
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    # 未通过sessions.set_store安装共享的store时, 使用进程内的store
+    if isinstance(sessions.store, sessions.MemorySessionStore):
+        sessions.set_store(sessions.MemorySessionStore(maxsize=configs.session.maxsize, ttl=configs.session.idle_timeout))
+    asyncio.ensure_future(sessions.purge_expired(configs.session.purge_interval))
+    if configs.markdown.cache_dir:
+        os.makedirs(configs.markdown.cache_dir, exist_ok=True)
+    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, page_cache_factory, response_factory])
+    init_jinja2(app, filters=dict(datetime=datetime_filter), **configs.templates)
     # add_routes导入模块名，调用add_route，内部app.router.add_route创建RequestHandler实例
     add_routes(app, 'handlers') # module_name为独立模块名，或带.的模块名的子模块
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000) # 当向服务器发出请求时，会进行中间层middlewares函数调用，并调用RequestHandler实例__call__函数，进行处理
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    handler = app.make_handler()
+    # 当向服务器发出请求时，会进行中间层middlewares函数调用，并调用RequestHandler实例__call__函数，进行处理
+    if sock is None:
+        # 多个worker各自绑定同一端口时需要SO_REUSEPORT, 由内核分配连接
+        srv = await loop.create_server(handler, configs.server.host, configs.server.port, reuse_port=configs.server.reuse_port if configs.server.workers > 1 else None)
+    else:
+        srv = await loop.create_server(handler, sock=sock)
+    logger.info('server started at http://%s:%s (pid %s)...', configs.server.host, configs.server.port, os.getpid())
+    return srv, handler
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='awesome-python3-webapp server')
+    parser.add_argument('--host', default=configs.server.host)
+    parser.add_argument('--port', type=int, default=configs.server.port)
+    parser.add_argument('--workers', type=int, default=configs.server.workers, help='number of worker processes, 0 for cpu count')
+    parser.add_argument('--loop', default=configs.server.loop, choices=['asyncio', 'uvloop', 'auto'], help='event loop implementation')
+    options = parser.parse_args()
+    configs.server.host = options.host
+    configs.server.port = options.port
+    configs.server.workers = options.workers or os.cpu_count()
+    configs.server.loop = options.loop
+    init_logging(**configs.logging)
+    if configs.server.workers > 1 and isinstance(sessions.store, sessions.MemorySessionStore):
+        logger.warning('in-process session store is not shared by %s workers, sign out and revoked sessions take effect only in one worker.', configs.server.workers)
+    server.run(init, configs.server.host, configs.server.port, workers=configs.server.workers, reuse_port=configs.server.reuse_port, health=worker_health, health_interval=configs.server.health_interval, loop=configs.server.loop)
 
 
 
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks, run against the database configured in config.
+'''
+
+__author__ = 'hpt'
+
+import asyncio, os, sys, time, logging, resource, tracemalloc, tempfile, shutil, subprocess, socket
+
+import orm
+from config import configs
+from models import Blog, Comment
+
+logging.getLogger().setLevel(logging.WARNING)
+
+BENCH_BLOG_ID = 'bench'
+
+def report(name, n, seconds, unit='rows'):
+    print('%-32s %8d %s %10.3f s %12.1f %s/s' % (name, n, unit, seconds, n / seconds if seconds else 0, unit))
+
+async def clean_comments():
+    await orm.execute('delete from `%s` where `blog_id`=?' % Comment.__table__, [BENCH_BLOG_ID])
+
+def make_comments(n, content_size=0):
+    padding = 'x' * content_size
+    return [Comment(blog_id=BENCH_BLOG_ID, user_id='bench', user_name='bench', user_image='', content='comment %d %s' % (i, padding)) for i in range(n)]
+
+def peak_rss():
+    # linux下ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# saveItem逐条插入 vs saveMany批量插入
+async def bench_save_many(n=5000, chunk_size=500):
+    await clean_comments()
+    items = make_comments(n)
+    t0 = time.time()
+    for item in items:
+        await Comment.saveItem(item)
+    report('saveItem loop', n, time.time() - t0)
+    await clean_comments()
+
+    items = make_comments(n)
+    t0 = time.time()
+    counts = await Comment.saveMany(items, chunk_size=chunk_size)
+    report('saveMany(chunk_size=%d)' % chunk_size, sum(counts), time.time() - t0)
+    await clean_comments()
+
+# iterAll服务端游标 vs findAll一次性加载, 比较峰值内存, iterAll需先运行
+async def bench_iter_all(n=1000000, content_size=1024):
+    await clean_comments()
+    for i in range(0, n, 10000):
+        await Comment.saveMany(make_comments(min(10000, n - i), content_size))
+
+    rss = peak_rss()
+    t0 = time.time()
+    count = 0
+    async for c in Comment.iterAll('blog_id=?', [BENCH_BLOG_ID], batch=500):
+        count = count + 1
+    report('iterAll(batch=500)', count, time.time() - t0)
+    print('%-32s %8d KB' % ('  peak rss growth', peak_rss() - rss))
+
+    rss = peak_rss()
+    t0 = time.time()
+    comments = await Comment.findAll('blog_id=?', [BENCH_BLOG_ID])
+    report('findAll', len(comments), time.time() - t0)
+    print('%-32s %8d KB' % ('  peak rss growth', peak_rss() - rss))
+    del comments
+    await clean_comments()
+
+# Model(dict子类) vs __slots__行对象: 内存占用与构造/属性访问速度
+async def bench_records(n=100000):
+    columns = [Comment.__primary_key__] + Comment.__fields__
+    rows = [tuple('%s-%d' % (c, i) for c in columns) for i in range(n)]
+    dict_rows = [dict(zip(columns, r)) for r in rows]
+    record = Comment.__record__
+    for name, build in (('Model(**dict)', lambda: [Comment(**r) for r in dict_rows]), ('Record(*tuple)', lambda: [record(*r) for r in rows])):
+        tracemalloc.start()
+        t0 = time.time()
+        objs = build()
+        report(name, n, time.time() - t0)
+        print('%-32s %8d KB' % ('  memory', tracemalloc.get_traced_memory()[0] // 1024))
+        tracemalloc.stop()
+        t0 = time.time()
+        for o in objs:
+            o.blog_id, o.content, o.created_at
+        report('  attribute access x3', n, time.time() - t0)
+        del objs
+
+    await clean_comments()
+    await Comment.saveMany(make_comments(n))
+    t0 = time.time()
+    comments = await Comment.findAll('blog_id=?', [BENCH_BLOG_ID])
+    report('findAll', len(comments), time.time() - t0)
+    t0 = time.time()
+    comments = await Comment.findRecords('blog_id=?', [BENCH_BLOG_ID])
+    report('findRecords', len(comments), time.time() - t0)
+    del comments
+    await clean_comments()
+
+# 开发模式(auto_reload) vs 生产模式(启动时预编译 + 字节码缓存)的模板启动时间和渲染速度
+async def bench_templates(n=10000):
+    from app import init_jinja2, datetime_filter
+    blogs = [Blog(id=str(i), name='Blog %d' % i, summary='summary %d' % i, created_at=time.time() - i * 3600) for i in range(10)]
+    bytecode_cache_dir = os.path.join(tempfile.mkdtemp(), 'jinja2')
+    production = dict(auto_reload=False, precompile=True, bytecode_cache_dir=bytecode_cache_dir)
+    modes = (
+        ('dev', dict(auto_reload=True)),
+        ('production, cold bytecode cache', production),
+        ('production, warm bytecode cache', production),
+        ('production, async', dict(production, enable_async=True))
+    )
+    for name, options in modes:
+        app = dict()
+        t0 = time.time()
+        init_jinja2(app, filters=dict(datetime=datetime_filter), **options)
+        env = app['__templating__']
+        env.get_template('blogs.html')
+        print('%-32s %10.3f ms startup' % (name, (time.time() - t0) * 1000))
+        t0 = time.time()
+        for i in range(n):
+            template = env.get_template('blogs.html')
+            if env.is_async:
+                await template.render_async(blogs=blogs, __user__=None)
+            else:
+                template.render(blogs=blogs, __user__=None)
+        report('  render blogs.html', n, time.time() - t0, 'renders')
+    shutil.rmtree(os.path.dirname(bytecode_cache_dir))
+
+class FakeRequest(object):
+    '''
+    Minimal stand-in of aiohttp request for RequestHandler benchmarks.
+    '''
+    def __init__(self, method='GET', match_info=None, query_string='', json=None):
+        self.method = method
+        self.match_info = match_info or {}
+        self.query_string = query_string
+        self.content_type = 'application/json' if json is not None else 'application/octet-stream'
+        self._json = json
+
+    async def json(self):
+        return dict(self._json)
+
+# 不同参数形式的视图函数, RequestHandler每秒可处理的请求数
+async def bench_handlers(n=100000):
+    from coroweb import get, post, RequestHandler
+
+    @get('/')
+    async def no_args(request):
+        return None
+
+    @get('/blog/{id}')
+    async def path_arg(id):
+        return None
+
+    @get('/api/blogs')
+    async def query_args(*, page='1', size='10'):
+        return None
+
+    @post('/api/blogs')
+    async def json_args(request, *, name, summary, content):
+        return None
+
+    cases = (
+        (no_args, FakeRequest()),
+        (path_arg, FakeRequest(match_info=dict(id='1'))),
+        (query_args, FakeRequest(query_string='page=2&size=20&other=x')),
+        (json_args, FakeRequest('POST', json=dict(name='n', summary='s', content='c')))
+    )
+    handlers = [(fn.__name__, RequestHandler(None, fn), request) for fn, request in cases]
+    results = []
+    for name, handler, request in handlers:
+        t0 = time.time()
+        for i in range(n):
+            await handler(request)
+        results.append((name, time.time() - t0))
+    for name, seconds in results:
+        report('RequestHandler %s' % name, n, seconds, 'requests')
+
+# 日志在事件循环线程中同步写入 vs 经队列由后台线程写入时, 事件循环的延迟
+async def bench_logging(n=50000, concurrency=100):
+    from logs import init_logging, stop_logging
+    logger = logging.getLogger('bench')
+    root = logging.getLogger()
+    saved = root.handlers[:], root.level
+    path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+
+    async def measure_lag(stop):
+        lags = []
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t0 - 0.001)
+        return sorted(lags)
+
+    async def worker(k):
+        for i in range(n // concurrency):
+            logger.info('GET /blog/%s from worker %s', i, k)
+            await asyncio.sleep(0)
+
+    def sync_handler(f):
+        root.addHandler(logging.StreamHandler(f))
+
+    def queue_handler(f):
+        init_logging(stream=f)
+
+    for name, setup in (('StreamHandler on event loop', sync_handler), ('QueueHandler + listener', queue_handler)):
+        with open(path, 'w') as f:
+            for h in root.handlers[:]:
+                root.removeHandler(h)
+            setup(f)
+            root.setLevel(logging.INFO)
+            stop = asyncio.Event()
+            lag_task = asyncio.ensure_future(measure_lag(stop))
+            t0 = time.time()
+            await asyncio.gather(*[worker(k) for k in range(concurrency)])
+            seconds = time.time() - t0
+            stop.set()
+            lags = await lag_task
+            stop_logging()
+        report(name, n, seconds, 'records')
+        print('%-32s p50 %.3f ms, p99 %.3f ms, max %.3f ms' % ('  event loop lag', lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    for h in saved[0]:
+        root.addHandler(h)
+    root.setLevel(saved[1])
+    shutil.rmtree(os.path.dirname(path))
+
+def start_server(port, *args):
+    # 在子进程中启动app.py, 等待端口可以连接
+    p = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'), '--port', str(port)] + list(args))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return p
+        except OSError:
+            time.sleep(0.2)
+    p.terminate()
+    raise RuntimeError('server not started at port %s' % port)
+
+def stop_server(p):
+    p.terminate()
+    p.wait()
+
+# 在duration秒内以concurrency个并发连接循环请求urls, 返回(成功数, 失败数, 排序后的延迟列表)
+async def load(urls, duration=10, concurrency=64):
+    import aiohttp
+    ok, errors, latencies = 0, 0, []
+    deadline = time.time() + duration
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def client(k):
+            nonlocal ok, errors
+            i = k
+            while time.time() < deadline:
+                url = urls[i % len(urls)]
+                i = i + 1
+                t0 = time.perf_counter()
+                try:
+                    async with session.get(url) as r:
+                        await r.read()
+                        if r.status == 200:
+                            ok = ok + 1
+                            latencies.append(time.perf_counter() - t0)
+                        else:
+                            errors = errors + 1
+                except aiohttp.ClientError:
+                    errors = errors + 1
+        await asyncio.gather(*[client(k) for k in range(concurrency)])
+    return ok, errors, sorted(latencies)
+
+# 不同worker进程数时的吞吐量, 压测客户端本身只使用一个核, 核数较多时应在其他机器上运行
+async def bench_workers(counts=(1, 2, 4), port=9100, duration=10, concurrency=64):
+    for n in counts:
+        p = start_server(port, '--workers', str(n))
+        try:
+            ok, errors, latencies = await load(['http://127.0.0.1:%s/' % port], duration, concurrency)
+        finally:
+            stop_server(p)
+        report('%d workers' % n, ok, duration, 'requests')
+        print('%-32s %8d errors' % ('', errors))
+
+# asyncio与uvloop事件循环下各页面的吞吐量和延迟, 需要数据库中至少有一篇日志
+async def bench_loops(loops=('asyncio', 'uvloop'), port=9100, duration=10, concurrency=64):
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=1)
+    if not blogs:
+        print('no blog found, create one first.')
+        return
+    base = 'http://127.0.0.1:%s' % port
+    paths = ('/', '/blog/%s' % blogs[0].id, '/api/blogs/%s' % blogs[0].id)
+    for name in loops:
+        p = start_server(port, '--workers', '1', '--loop', name)
+        try:
+            for path in paths:
+                ok, errors, latencies = await load([base + path], duration, concurrency)
+                report('%s %s' % (name, path), ok, duration, 'requests')
+                if latencies:
+                    print('%-32s p50 %.3f ms, p99 %.3f ms, %d errors' % ('  latency', latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, errors))
+        finally:
+            stop_server(p)
+
+# 50篇日志的首页: 逐篇查询评论和评论数(N+1) vs loadFor/countFor批量查询
+async def bench_relations(blogs=50, comments=20, rounds=100):
+    async def clean():
+        await orm.execute('delete from `%s` where `blog_id` like ?' % Comment.__table__, ['bench-%'])
+        await orm.execute('delete from `%s` where `id` like ?' % Blog.__table__, ['bench-%'])
+    await clean()
+    items = [Blog(id='bench-%d' % i, user_id='bench', user_name='bench', user_image='', name='Blog %d' % i, summary='', content='', created_at=time.time() - i) for i in range(blogs)]
+    await Blog.saveMany(items)
+    for b in items:
+        await Comment.saveMany([Comment(blog_id=b.id, user_id='bench', user_name='bench', user_image='', content='comment %d' % i) for i in range(comments)])
+
+    t0 = time.time()
+    for i in range(rounds):
+        page = await Blog.findAll('`id` like ?', ['bench-%'], orderBy='created_at desc', limit=blogs)
+        for b in page:
+            b.comments = await Comment.findAll('blog_id=?', [b.id], orderBy='created_at desc')
+            b.comments_count = await Comment.findNumber('count(id)', 'blog_id=?', [b.id])
+    report('per blog queries (%d/page)' % (1 + blogs * 2), rounds, time.time() - t0, 'pages')
+
+    t0 = time.time()
+    for i in range(rounds):
+        page = await Blog.findAll('`id` like ?', ['bench-%'], orderBy='created_at desc', limit=blogs)
+        await Comment.loadFor(page, 'blog_id', orderBy='created_at desc')
+        await Comment.countFor(page, 'blog_id')
+    report('loadFor + countFor (3/page)', rounds, time.time() - t0, 'pages')
+    await clean()
+
+BENCHMARKS = dict(
+    save_many=bench_save_many,
+    iter_all=bench_iter_all,
+    records=bench_records,
+    templates=bench_templates,
+    handlers=bench_handlers,
+    logging=bench_logging,
+    workers=bench_workers,
+    loops=bench_loops,
+    relations=bench_relations
+)
+
+async def main(loop, names):
+    await orm.create_pool(loop=loop, **configs.database)
+    for name in names:
+        print('==== %s ====' % name)
+        await BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    # python bench.py [name...], 不指定时运行全部
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, names))
+    loop.close()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+In-process caches.
+'''
+
+__author__ = 'hpt'
+
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    In-process LRU cache with optional ttl (seconds). Any object which has the same
+    get(key), set(key, value), delete(key), clear() and stats() methods can be used
+    as a cache backend instead, e.g. a client of a shared store.
+    '''
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key => (value, expires)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key) # 最近访问的移到末尾, 淘汰时从头部开始
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, None if ttl is None else time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def purge(self):
+        'remove expired entries, return number of removed entries.'
+        now = time.monotonic()
+        expired = [k for k, (v, expires) in self._data.items() if expires is not None and expires < now]
+        for k in expired:
+            del self._data[k]
+        return len(expired)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses, evictions=self.evictions, hit_rate=self.hits / total if total else 0.0)
+
+class PageCache(object):
+    '''
+    Rendered responses keyed by (path, query string, user class).
+    '''
+    def __init__(self, maxsize=1000, ttl=60):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def configure(self, maxsize, ttl):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, entry):
+        self._cache.set(key, entry)
+
+    def invalidate(self, *paths):
+        '''
+        Remove cached pages by path, a path ends with '*' matches as prefix, no paths clears all.
+        '''
+        if not paths:
+            self._cache.clear()
+            return
+        for key in self._cache.keys():
+            path = key[0]
+            for p in paths:
+                if path == p or (p.endswith('*') and path.startswith(p[:-1])):
+                    self._cache.delete(key)
+                    break
+
+    def stats(self):
+        return self._cache.stats()
+
+# 整页缓存, 由app中的page_cache_factory使用, 写操作的handler调用pages.invalidate()清除
+pages = PageCache()
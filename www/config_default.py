@@ -9,14 +9,70 @@ __author__ = 'hpt'
 
 configs = {
     'debug': True,
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        # worker进程数, 0表示与cpu核数相同
+        'workers': 1,
+        # True: 每个worker以SO_REUSEPORT绑定端口; False: master绑定端口, worker继承socket
+        'reuse_port': True,
+        # worker报告状态的间隔(秒)
+        'health_interval': 10,
+        # 事件循环: 'asyncio', 'uvloop'或'auto'(已安装uvloop时使用)
+        'loop': 'asyncio'
+    },
     'database': {
+        # mysql, 或sqlite(db为数据库文件路径, 用于本地运行和测试)
+        'driver': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'db': 'test_db'
+        'db': 'test_db',
+        'maxsize': 50,
+        'minsize': 1,
+        # 获取连接最多等待的秒数, None为一直等待
+        'acquire_timeout': 5,
+        # 按最近的并发峰值调整minsize
+        'adaptive': False,
+        'adaptive_interval': 10,
+        # 只读副本, 每项覆盖上面的连接参数, 如[{'host': '10.0.0.2'}], select从副本读取, 写入和事务使用主库
+        'replicas': [],
+        # 选择副本的方式: round_robin 轮流, least_busy 使用中和等待的连接最少的副本
+        'replica_select': 'round_robin'
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        # cookie有效期(秒), 剩余不足一半时自动换发
+        'max_age': 86400,
+        # 内存中最多保存的session数, 以及无访问多久后从内存中清除(秒)
+        'maxsize': 100000,
+        'idle_timeout': 3600,
+        'purge_interval': 60
+    },
+    'markdown': {
+        'cache_size': 1000,
+        # 渲染结果的磁盘缓存目录, None表示只使用内存缓存
+        'cache_dir': None
+    },
+    'templates': {
+        # 开发时自动重新加载修改过的模板; 生产环境设为False, 并开启precompile和bytecode_cache_dir
+        'auto_reload': True,
+        'precompile': False,
+        'bytecode_cache_dir': None,
+        'enable_async': False
+    },
+    'logging': {
+        'level': 'INFO',
+        'format': 'text', # 'text'或'json'
+        # 按模块设置日志级别, 如'orm': 'WARNING'
+        'levels': {},
+        # SQL日志的采样比例
+        'sql_sample_rate': 1.0
+    },
+    'page_cache': {
+        'enabled': True,
+        'maxsize': 1000,
+        'ttl': 60
     }
 }
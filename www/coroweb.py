@@ -8,6 +8,8 @@ from urllib import parse
 from aiohttp import web
 from apis import APIError
 
+logger = logging.getLogger(__name__)
+
 # def get(path):
 #     '''
 #     Define decorator @get('/path')
@@ -35,13 +37,17 @@ from apis import APIError
 #     return decorator
 
 # 建立视图函数装饰器，用来存储、附带URL信息
-def handler_decorator(path, *, method):
+# public=True表示视图函数不需要当前用户, auth_factory不为其解析cookie
+# cache=True表示响应可以由page_cache_factory缓存, 默认不缓存
+def handler_decorator(path, *, method, public=False, cache=False):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = method
         wrapper.__route__ = path
+        wrapper.__public__ = public
+        wrapper.__cache__ = cache
         return wrapper
     return decorator
 # 偏函数。GET POST 方法的路由装饰器
@@ -122,11 +128,47 @@ RequestHandler需要处理以下问题：
 3、将获取的参数经处理，使其完全符合视图函数接收的参数形式
 4、调用视图函数
 '''
+# 解析POST请求body中的参数, 返回dict, 或出错时返回400响应
+async def parse_body_args(request):
+    if not request.content_type:
+        return web.HTTPBadRequest(text='Missing Content-Type.')
+    ct = request.content_type.lower()
+    if ct.startswith('application/json'):
+        params = await request.json() # 仅解析body字段的json数据
+        if not isinstance(params, dict): # request.json()返回dict对象
+            return web.HTTPBadRequest(text='JSON body must be object.')
+        return params
+    # form表单请求的编码形式
+    if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        params = await request.post() # 返回post的内容中解析后的数据。dict-like对象。
+        return dict(**params) # 组成dict，统一kw格式
+    return web.HTTPBadRequest(text='Unsurpported Content-Type: %s' % request.content_type)
+
+# 解析GET请求URL中的参数, 没有参数时返回None
+async def parse_query_args(request):
+    qs = request.query_string # 返回URL查询语句，?后的键值。string形式。
+    if not qs:
+        return None
+    '''
+    解析url中?后面的键值对的内容
+    qs = 'first=f,s&second=s'
+    parse.parse_qs(qs, True).items()
+    >>> dict([('first', ['f,s']), ('second', ['s'])])
+    '''
+    return {k: v[0] for k, v in parse.parse_qs(qs, True).items()} # True表示不忽略空格。
+
+# 路由的method未知时按请求的method解析
+async def parse_request_args(request):
+    if request.method == 'POST':
+        return (await parse_body_args(request))
+    if request.method == 'GET':
+        return (await parse_query_args(request))
+    return None
+
 # 定义RequestHandler从视图函数中分析其需要接受的参数，从web.Request中获取必要的参数
 # 调用视图函数，然后把结果转换为web.Response对象，符合aiohttp框架要求
 class RequestHandler(object):
     def __init__(self, app, fn):
-        print('RequestHandler--__init__....')
         self._app = app
         self._func = fn
         self._has_request_arg = has_request_arg(fn)
@@ -134,77 +176,67 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
-    
-    # 1.定义kw，用于保存参数
-    # 2.判断视图函数是否存在关键词参数，如果存在根据POST或者GET方法将request请求内容保存到kw
-    # 3.如果kw为空（说明request无请求内容），则将match_info列表里的资源映射给kw；若不为空，把命名关键词参数内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    async def __call__(self, request):
-        print('RequestHandler--__call__....')
-        print('request =', request, '; method =', request.method, '; content_type =', request.content_type)
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            print('@@@@@@@@@@@@@@@@@@@@')
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest(text='Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json() # 仅解析body字段的json数据
-                    if not isinstance(params, dict): # request.json()返回dict对象
-                        return web.HTTPBadRequest(text='JSON body must be object.')
-                    kw = params
-                # form表单请求的编码形式
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post() # 返回post的内容中解析后的数据。dict-like对象。
-                    kw = dict(**params) # 组成dict，统一kw格式
-                else:
-                    return web.HTTPBadRequest(text='Unsurpported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string # 返回URL查询语句，?后的键值。string形式。
-                if qs:
-                    kw = dict()
-                    '''
-                    解析url中?后面的键值对的内容
-                    qs = 'first=f,s&second=s'
-                    parse.parse_qs(qs, True).items()
-                    >>> dict([('first', ['f,s']), ('second', ['s'])])
-                    '''
-                    for k, v in parse.parse_qs(qs, True).items(): # 返回查询变量和值的映射，dict对象。True表示不忽略空格。
-                        kw[k] = v[0]
-        
-        if kw is None: # 若request中无参数
-            print('#################')
-            # request.match_info返回dict对象。可变路由中的可变字段{variable}为参数名，传入request请求的path为值
-            # 若存在可变路由：/a/{name}/c，可匹配path为：/a/jack/c的request
-            # 则reqwuest.match_info返回{name = jack}
-            kw = dict(**request.match_info)
-        else: # request有参数
-            print('======================')
-            if not self._has_var_kw_arg and self._named_kw_args: # 若视图函数只有命名关键词参数没有关键词参数
-                # remove all unnamed kw:
-                copy = dict()
-                # 只保留命名关键词参数
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy # kw中只存在命名关键词参数
-            # 将request.match_info中的参数传入kw
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Dumplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg: # 视图函数存在request参数
-            print('---------------------')
-            kw['request'] = request
-        if self._required_kw_args: # 视图函数存在无默认值的命名关键词参数
-            print('&&&&&&&&&&&&&&&&&&&&&&&')
-            for name in self._required_kw_args:
+        self._bind = self.make_binder(getattr(fn, '__method__', None))
+
+    '''
+    根据视图函数的参数形式, 在注册路由时生成专用的参数绑定函数bind(request), 每次请求不必再重复判断：
+    1、视图函数没有关键词参数时，只需要request.match_info中的参数（和request）
+    2、否则根据路由的method选择解析body或URL中的参数，存在参数时只保留命名关键词参数（无**kw时），再加入match_info中的参数
+    3、加入request，检查无默认值的命名关键词参数
+    bind返回调用视图函数的kw，或请求参数错误时返回400响应
+    '''
+    def make_binder(self, method):
+        has_request_arg = self._has_request_arg
+        if not self._has_var_kw_arg and not self._has_named_kw_args:
+            if has_request_arg:
+                async def bind(request):
+                    kw = dict(**request.match_info)
+                    kw['request'] = request
+                    return kw
+            else:
+                async def bind(request):
+                    return dict(**request.match_info)
+            return bind
+
+        if method == 'POST':
+            parse_args = parse_body_args
+        elif method == 'GET':
+            parse_args = parse_query_args
+        else:
+            parse_args = parse_request_args
+        # 视图函数只有命名关键词参数没有关键词参数时, 只保留命名关键词参数
+        named_kw_args = None if self._has_var_kw_arg else self._named_kw_args
+        required_kw_args = self._required_kw_args
+        async def bind(request):
+            kw = await parse_args(request)
+            if kw is None: # 若request中无参数
+                # request.match_info返回dict对象。可变路由中的可变字段{variable}为参数名，传入request请求的path为值
+                kw = dict(**request.match_info)
+            elif not isinstance(kw, dict):
+                return kw # 400错误
+            else:
+                if named_kw_args:
+                    kw = {name: kw[name] for name in named_kw_args if name in kw}
+                # 将request.match_info中的参数传入kw
+                for k, v in request.match_info.items():
+                    if k in kw:
+                        logger.warning('Dumplicate arg name in named arg and kw args: %s', k)
+                    kw[k] = v
+            if has_request_arg:
+                kw['request'] = request
+            for name in required_kw_args:
                 if not name in kw: # 若未传入必须参数值，报错。
                     return web.HTTPBadRequest(text='Missing argument: %s' % name)
+            return kw
+        return bind
+
+    async def __call__(self, request):
+        kw = await self._bind(request)
+        if not isinstance(kw, dict):
+            return kw
         # 至此，kw为视图函数fn真正能调用的参数
         # request请求中的参数，终于传递给了视图函数
-        logging.info('call with args: %s' % str(kw))
+        logger.debug('call with args: %s', kw)
         try:
             r = await self._func(**kw)
             return r
@@ -226,9 +258,35 @@ def add_route(app, fn):
     # 判断URL处理函数是否协程并且是生成器
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn) # 将fn转变成协程
-    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    logger.info('add route %s %s => %s(%s)', method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys()))
     # 在app中注册经RequestHandler类封装的视图函数，至此，RequestHandler的__call__直接处理视图函数
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    route = app.router.add_route(method, path, RequestHandler(app, fn))
+    if getattr(fn, '__public__', False):
+        app.setdefault('__public_routes__', set()).add(route)
+    if getattr(fn, '__cache__', False):
+        app.setdefault('__cache_routes__', set()).add(route)
+
+# 静态文件和public路由不需要解析当前用户
+def is_public(request):
+    if request.path.startswith('/static/'):
+        return True
+    return request.match_info.route in request.app.get('__public_routes__', ())
+
+# 只有声明了cache=True的路由可以缓存
+def is_cacheable(request):
+    return request.match_info.route in request.app.get('__cache_routes__', ())
+
+async def current_user(request):
+    '''
+    Return current user of request, it is resolved at the first call and cached in request.__user__.
+    '''
+    try:
+        return request.__user__
+    except AttributeError:
+        pass
+    load_user = getattr(request, '__load_user__', None)
+    request.__user__ = None if load_user is None else (await load_user())
+    return request.__user__
 
 # 导入模块，批量注册视图函数
 def add_routes(app, module_name):
@@ -267,4 +325,4 @@ def add_static(app):
     # path = os.path.join(os.path.abspath('.'), 'static')
     
     app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+    logger.info('add static %s => %s', '/static/', path)
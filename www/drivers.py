@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Database drivers used by orm. A driver creates pools and runs statements on a
+connection of its pool, statements use '?' placeholders and are translated by orm
+to the placeholder style of the driver.
+'''
+
+__author__ = 'hpt'
+
+import asyncio, collections, logging
+
+logger = logging.getLogger(__name__)
+
+class Driver(object):
+    '''
+    Interface of drivers. A pool has acquire(), release(conn), shrink(target), size, freesize,
+    minsize, maxsize, close() and wait_closed(), rows are dicts, or tuples if tuples is True.
+    '''
+    name = None
+    placeholder = '?'
+
+    async def create_pool(self, loop, **kw):
+        raise NotImplementedError()
+
+    async def describe(self, conn, table):
+        'return ({column: type}, [(index name, columns, unique), ...]) of table, or None if table does not exist.'
+        raise NotImplementedError()
+
+    async def query(self, conn, sql, args, size=None, tuples=False):
+        raise NotImplementedError()
+
+    async def iterate(self, conn, sql, args, batch):
+        'async generator of lists of at most batch rows.'
+        raise NotImplementedError()
+        yield
+
+    async def execute(self, conn, sql, args):
+        'return affected rows.'
+        raise NotImplementedError()
+
+    async def begin(self, conn):
+        await self.execute(conn, 'BEGIN', ())
+
+    async def commit(self, conn):
+        await self.execute(conn, 'COMMIT', ())
+
+    async def rollback(self, conn):
+        await self.execute(conn, 'ROLLBACK', ())
+
+    def retryable(self, e):
+        'return True if the transaction failed by e can be run again, e.g. deadlock.'
+        return False
+
+    def rolled_back(self, e):
+        'return True if the database has rolled back the whole transaction because of e.'
+        return False
+
+class MySQLDriver(Driver):
+    '''
+    MySQL by aiomysql.
+    '''
+    name = 'mysql'
+    placeholder = '%s'
+
+    # 死锁(1213)和锁等待超时(1205)时, 整个事务重新执行即可
+    RETRY_ERRORS = (1213, 1205)
+    # 死锁时MySQL回滚整个事务; 锁等待超时默认只回滚当前语句(innodb_rollback_on_timeout=OFF)
+    ROLLBACK_ERRORS = (1213,)
+
+    def __init__(self):
+        import aiomysql
+        self.aiomysql = aiomysql
+
+    async def create_pool(self, loop, **kw):
+        return MySQLPool(await self.aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            # 这个必须设置,否则,从数据库获取到的结果是乱码的
+            charset=kw.get('charset', 'utf8'),
+            # 是否自动提交事务,在增删改数据库数据时,如果为True,不需要再commit来提交事务了
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 50),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        ))
+
+    async def query(self, conn, sql, args, size=None, tuples=False):
+        # tuples=True时返回按列顺序的元组, 省去每行构造dict
+        async with conn.cursor(self.aiomysql.Cursor if tuples else self.aiomysql.DictCursor) as cur:
+            await cur.execute(sql, args or ())
+            if size:
+                return (await cur.fetchmany(size))
+            return (await cur.fetchall())
+
+    async def iterate(self, conn, sql, args, batch):
+        # 使用服务端游标(SSDictCursor)按批返回结果,结果集不会一次全部加载到内存
+        async with conn.cursor(self.aiomysql.SSDictCursor) as cur:
+            await cur.execute(sql, args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                yield rs
+
+    async def execute(self, conn, sql, args):
+        async with conn.cursor() as cur:
+            await cur.execute(sql, args or None)
+            return cur.rowcount
+
+    async def begin(self, conn):
+        await conn.begin()
+
+    async def commit(self, conn):
+        await conn.commit()
+
+    async def rollback(self, conn):
+        await conn.rollback()
+
+    async def describe(self, conn, table):
+        columns = await self.query(conn, 'select column_name as name, column_type as type from information_schema.columns where table_schema=database() and table_name=%s order by ordinal_position', [table])
+        if not columns:
+            return None
+        rs = await self.query(conn, 'select index_name as name, column_name as col, non_unique from information_schema.statistics where table_schema=database() and table_name=%s order by index_name, seq_in_index', [table])
+        indexes = collections.OrderedDict()
+        for r in rs:
+            if r['name'] != 'PRIMARY':
+                indexes.setdefault(r['name'], (r['name'], [], not r['non_unique']))[1].append(r['col'])
+        return dict((c['name'], c['type']) for c in columns), [(n, tuple(cols), unique) for n, cols, unique in indexes.values()]
+
+    def retryable(self, e):
+        return self.error_code(e) in self.RETRY_ERRORS
+
+    def rolled_back(self, e):
+        return self.error_code(e) in self.ROLLBACK_ERRORS
+
+    def error_code(self, e):
+        if isinstance(e, (self.aiomysql.OperationalError, self.aiomysql.InternalError)) and e.args:
+            return e.args[0]
+        return None
+
+class MySQLPool(object):
+    '''
+    aiomysql pool with shrink(target), other attributes are of the aiomysql pool.
+    '''
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    async def shrink(self, target):
+        'set minsize to target and close free connections more than target.'
+        pool = self._pool
+        pool._minsize = target # aiomysql在下次acquire时补足到minsize
+        while pool._free and pool.size > target:
+            pool._free.popleft().close() # aiomysql的close()直接关闭连接, 不是协程
+
+class SQLitePool(object):
+    '''
+    Pool of aiosqlite connections to one database file, ':memory:' allows only one connection.
+    '''
+    def __init__(self, connect, maxsize, minsize):
+        self._connect = connect
+        self.maxsize = maxsize
+        self._minsize = minsize
+        self._free = collections.deque()
+        self._used = set()
+        self._semaphore = asyncio.Semaphore(maxsize)
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def acquire(self):
+        await self._semaphore.acquire()
+        try:
+            conn = self._free.popleft() if self._free else (await self._connect())
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self._used.add(conn)
+        return conn
+
+    def release(self, conn):
+        self._used.discard(conn)
+        self._free.append(conn)
+        self._semaphore.release()
+
+    async def shrink(self, target):
+        'set minsize to target and close free connections more than target.'
+        self._minsize = target
+        while self._free and self.size > target:
+            conn = self._free.popleft()
+            await conn.close()
+
+    def close(self):
+        self._closing = [conn.close() for conn in list(self._free) + list(self._used)]
+        self._free.clear()
+        self._used.clear()
+
+    async def wait_closed(self):
+        for c in getattr(self, '_closing', ()):
+            await c
+
+class SQLiteDriver(Driver):
+    '''
+    SQLite by aiosqlite, db is the path of database file or ':memory:'. For local runs, tests
+    and small deployments, the sql of Model is the same as MySQL except DDL.
+    '''
+    name = 'sqlite'
+    placeholder = '?'
+
+    def __init__(self):
+        import aiosqlite
+        self.aiosqlite = aiosqlite
+
+    async def create_pool(self, loop, **kw):
+        db = kw.get('db', ':memory:')
+        async def connect():
+            # isolation_level=None: 自动提交, 事务由BEGIN/COMMIT显式控制
+            conn = await self.aiosqlite.connect(db, isolation_level=None)
+            conn.row_factory = self.aiosqlite.Row
+            # pragma返回结果行, 游标不关闭时语句未结束, 其他连接切换WAL时会遇到database is locked
+            async with conn.execute('PRAGMA journal_mode=WAL' if db != ':memory:' else 'PRAGMA foreign_keys=OFF') as cur:
+                await cur.fetchall()
+            return conn
+        # 每个:memory:连接是一个独立的数据库, 只能使用一个连接
+        maxsize = 1 if db == ':memory:' else kw.get('maxsize', 5)
+        return SQLitePool(connect, maxsize, min(kw.get('minsize', 1), maxsize))
+
+    async def query(self, conn, sql, args, size=None, tuples=False):
+        async with conn.execute(sql, args or ()) as cur:
+            rs = (await cur.fetchmany(size)) if size else (await cur.fetchall())
+        convert = tuple if tuples else dict
+        return [convert(r) for r in rs]
+
+    async def iterate(self, conn, sql, args, batch):
+        async with conn.execute(sql, args or ()) as cur:
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                yield [dict(r) for r in rs]
+
+    async def execute(self, conn, sql, args):
+        async with conn.execute(sql, args or ()) as cur:
+            return cur.rowcount
+
+    async def describe(self, conn, table):
+        columns = await self.query(conn, 'pragma table_info(`%s`)' % table, ())
+        if not columns:
+            return None
+        indexes = []
+        for r in await self.query(conn, 'pragma index_list(`%s`)' % table, ()):
+            if r['origin'] == 'pk':
+                continue
+            cols = await self.query(conn, 'pragma index_info(`%s`)' % r['name'], ())
+            indexes.append((r['name'], tuple(c['name'] for c in sorted(cols, key=lambda c: c['seqno'])), bool(r['unique'])))
+        return dict((c['name'], c['type']) for c in columns), indexes
+
+    # SQLITE_BUSY时事务仍然有效, 只是语句没有执行, 不会回滚事务
+    def retryable(self, e):
+        return isinstance(e, self.aiosqlite.OperationalError) and 'locked' in str(e)
+
+DRIVERS = dict(mysql=MySQLDriver, sqlite=SQLiteDriver)
+
+def get_driver(name):
+    if name not in DRIVERS:
+        raise ValueError('Invalid database driver: %s' % name)
+    return DRIVERS[name]()
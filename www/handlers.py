@@ -6,25 +6,32 @@ __author__ = 'hpt'
 ' url handlers '
 
 
-import asyncio, time, re, logging, json, hashlib, base64
+import asyncio, os, time, re, logging, json, hashlib, hmac, base64, tempfile
 
 from aiohttp import web
 
 import markdown2
 
-from coroweb import get, post
+from coroweb import get, post, current_user
 
+import orm, schema
 from models import User, Blog, Comment, next_id
 from apis import APIError, APIValueError, APIPermissionError
 from config import configs
+from cache import LRUCache, pages
+import sessions
+
+logger = logging.getLogger(__name__)
 
 COOKIE_NAME = 'awesession'
-_COOKIE_KEY = 'configs.session.secret'
+_COOKIE_KEY = configs.session.secret
+_COOKIE_MAX_AGE = configs.session.max_age
 
-def check_admin(request):
-    if request.__user__ is None or not request.__user__.admin:
-        print('check_admin fail....')
+async def check_admin(request):
+    user = await current_user(request)
+    if user is None or not user.admin:
         raise APIPermissionError()
+    return user
 
 def get_page_index(page_str):
     p = 1
@@ -36,56 +43,173 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 密码版本: 密码改变后版本随之改变, 使用密钥计算, cookie中的版本不能用于离线猜测密码
+def passwd_version(passwd):
+    return hmac.new(_COOKIE_KEY.encode('utf-8'), passwd.encode('utf-8'), hashlib.sha256).hexdigest()[:8]
+
+def cookie_signature(payload):
+    return hmac.new(_COOKIE_KEY.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).hexdigest()
+
+def session2cookie(session, max_age):
+    '''
+    Generate cookie str by session dict of id, admin, name, image and passwd version.
+    '''
+    # build cookie string by: base64(json([id, expires, admin, name, image, passwd version])).hmac
+    expires = int(time.time() + max_age)
+    L = [session['id'], expires, session['admin'], session['name'], session['image'], session['version']]
+    payload = base64.urlsafe_b64encode(json.dumps(L, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+    return '%s.%s' % (payload, cookie_signature(payload))
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
     '''
-    print('user2cookie......')
-    # build cookie string by: id-expires-sha1
-    expires = str(int(time.time() + max_age))
-    s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
-    return '-'.join(L)
+    return session2cookie(dict(id=user.id, admin=bool(user.admin), name=user.name, image=user.image, version=passwd_version(user.passwd)), max_age)
 
-async def cookie2user(cookie_str):
+async def cookie2session(cookie_str):
     '''
-    Parse cookie and load user if cookie is valid.
+    Return session of cookie, verify cookie and put session into store if it is not in session store.
     '''
-    print('cookie2user......', cookie_str)
     if not cookie_str:
         return None
     try:
-        L = cookie_str.split('-')
-        if len(L) != 3:
-            return None
-        uid, expires, sha1 = L
-        if int(expires) < time.time():
+        session = await sessions.store.get(cookie_str)
+        if session is None:
+            L = cookie_str.split('.')
+            if len(L) != 2:
+                return None
+            payload, signature = L
+            if not hmac.compare_digest(signature, cookie_signature(payload)):
+                logger.info('invalid signature.')
+                return None
+            if await sessions.store.revoked(cookie_str):
+                return None
+            uid, expires, admin, name, image, version = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+            session = dict(id=uid, expires=expires, admin=admin, name=name, image=image, version=version)
+            await sessions.store.set(cookie_str, session)
+        if session['expires'] < time.time():
             return None
-        user = await User.find(uid)
-        print('cookie2user----', user)
-        if user is None:
+        if await sessions.store.revoked(revoked_user_key(session['id'], session['version'])):
+            logger.info('revoked session of user: %s', session['id'])
             return None
-        s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
-        if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
-            logging.info('invalid sha1.')
-            return None
-        user.passwd = '******'
-        return user # 将user返回到auth_factory
+        return session
     except Exception as e:
-        logging.exception(e)
+        logger.exception(e)
         return None
 
+def session2user(session):
+    return User(id=session['id'], email='', passwd='******', name=session['name'], admin=session['admin'], image=session['image'])
+
+async def cookie2user(cookie_str):
+    '''
+    Parse cookie and build user from session, no database query is needed.
+    '''
+    session = await cookie2session(cookie_str)
+    if session is None:
+        return None
+    return session2user(session) # 将user返回到auth_factory
+
+# 剩余有效期不足一半时, 返回新的cookie, 活跃用户的登录状态不会过期
+def renew_cookie(session):
+    if session['expires'] - time.time() < _COOKIE_MAX_AGE / 2:
+        return session2cookie(session, _COOKIE_MAX_AGE)
+    return None
+
+# 已撤销的session记录在session store中, 多个worker共享: 退出登录的cookie, 以及修改密码等情况下按(uid, 密码版本)撤销的全部session
+def revoked_user_key(uid, version):
+    return 'user:%s:%s' % (uid, version)
+
+async def revoke_session(cookie_str):
+    '''
+    Revoke one session, e.g. when user signed out.
+    '''
+    if cookie_str:
+        await sessions.store.revoke(cookie_str, _COOKIE_MAX_AGE)
+        await sessions.store.delete(cookie_str)
+
+async def revoke_user(uid, passwd):
+    '''
+    Revoke all sessions issued with the passwd of user, e.g. when passwd changed or admin removed.
+    '''
+    await sessions.store.revoke(revoked_user_key(uid, passwd_version(passwd)), _COOKIE_MAX_AGE)
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+# markdown渲染结果缓存, key为内容和extras的hash, 内容不变就不必重新渲染
+_MARKDOWN_EXTRAS = ()
+_markdown_cache = LRUCache(maxsize=configs.markdown.cache_size)
+_markdown_stats = dict(renders=0, render_seconds=0.0, saved_seconds=0.0)
+
+def markdown_key(content, extras=_MARKDOWN_EXTRAS):
+    s = '%s\n%s' % (','.join(sorted(extras)), content)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def read_cache_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# 先写入同一目录下的临时文件再替换, 其他进程不会读到只写了一部分的文件
+def write_cache_file(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+async def markdown_html(content):
+    '''
+    Render markdown content to html, cached in memory and optionally in configs.markdown.cache_dir.
+    '''
+    key = markdown_key(content)
+    cached = _markdown_cache.get(key)
+    if cached is not None:
+        html, seconds = cached
+        _markdown_stats['saved_seconds'] += seconds
+        return html
+    cache_dir = configs.markdown.cache_dir
+    path = os.path.join(cache_dir, '%s.html' % key) if cache_dir else None
+    # 文件读写在线程池中执行, 不阻塞事件循环
+    loop = asyncio.get_event_loop()
+    if path:
+        # 磁盘缓存只是优化, 读写失败时记录日志, 照常渲染返回
+        try:
+            html = await loop.run_in_executor(None, read_cache_file, path)
+        except OSError as e:
+            logger.warning('failed to read markdown cache %s: %s', path, e)
+            html = None
+        if html is not None:
+            _markdown_cache.set(key, (html, 0.0))
+            return html
+    t0 = time.time()
+    html = markdown2.markdown(content, extras=list(_MARKDOWN_EXTRAS))
+    seconds = time.time() - t0
+    _markdown_stats['renders'] += 1
+    _markdown_stats['render_seconds'] += seconds
+    _markdown_cache.set(key, (html, seconds))
+    if path:
+        try:
+            await loop.run_in_executor(None, write_cache_file, path, html)
+        except OSError as e:
+            logger.warning('failed to write markdown cache %s: %s', path, e)
+    return html
+
+def markdown_stats():
+    return dict(_markdown_stats, **_markdown_cache.stats())
+
 # # 同一时间创建，会出现id一致，主键重复错误
 # tom = User(email='57937554@qq.com', passwd='232434', admin=True, name='Tom')
 # lily = User(id='00154235346346aljfdlsjfldsjfld', email='32434354@qq.com', passwd='565231', name='Lily')
 
 @get('/users')
 async def index(request):
-    print('test_view.py--/users')
     # await User.saveItem(tom)
     # await User.saveItem(lily)
     users = await User.findAll()
@@ -101,9 +225,8 @@ async def index(request):
 #     print('test_view.py--/')
 #     return b'<h1>Awesome</h1>'
 
-@get('/')
+@get('/', cache=True)
 async def hello(request):
-    print('test_view.py--/')
     summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     blogs = [
         Blog(id='1', name='Test Blog', summary=summary, created_at=time.time() - 120),
@@ -115,13 +238,13 @@ async def hello(request):
         'blogs': blogs
     }
 
-@get('/blog/{id}')
+@get('/blog/{id}', cache=True)
 async def get_blog(id):
     blog = await Blog.find(id)
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    blog.html_content = await markdown_html(blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
@@ -138,29 +261,25 @@ async def get_blog(id):
 
 ####################################################################
 
-@get('/register')
+@get('/register', public=True)
 def register():
-    print('/register-----register......')
     return {
         '__template__': 'register.html'
     }
 
-@get('/signin')
+@get('/signin', public=True)
 def signin():
-    print('/signin-----signin......')
     return {
         '__template__': 'signin.html'
     }
 
-@post('/api/authenticate')
+@post('/api/authenticate', public=True)
 async def authenticate(*, email, passwd):
-    print('/api/authenticate-----authenticate......')
     if not email:
         raise APIValueError('email', 'Invalid email.')
     if not passwd:
         raise APIValueError('passwd', 'Invalid password.')
     users = await User.findAll('email=?', [email]) # (where, args)->('email=?', [email])
-    print(users)
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0]
@@ -169,24 +288,22 @@ async def authenticate(*, email, passwd):
     sha1.update(user.id.encode('utf-8'))
     sha1.update(b':')
     sha1.update(passwd.encode('utf-8'))
-    print(passwd, sha1.hexdigest())
     if user.passwd != sha1.hexdigest():
         raise APIValueError('passwd', 'Invalid password.')
     # authenticate ok, set cookie:
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, user2cookie(user, _COOKIE_MAX_AGE), max_age=_COOKIE_MAX_AGE, httponly=True)
     user.passwd = '******'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
-    print('r=====', r)
     return r
 
-@get('/signout')
-def signout(request):
-    print('/signout-----signout......')
+@get('/signout', public=True)
+async def signout(request):
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')
+    await revoke_session(request.cookies.get(COOKIE_NAME))
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
-    logging.info('user signed out.')
+    logger.info('user signed out.')
     return r
 
 @get('/manage/blogs/create')
@@ -200,28 +317,28 @@ def manage_create_blog():
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$') # hao123@qq.www.ten.com
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
-@post('/api/users')
+@post('/api/users', public=True)
+@orm.retry_on_deadlock()
 async def api_register_user(*, email, name, passwd):
-    print('/api/users-----api_register_user......')
     if not name or not name.strip():
         raise APIValueError('name')
     if not email or not _RE_EMAIL.match(email):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = await User.findAll('email=?', [email])
-    if len(users) > 0:
-        raise APIError('rigister:failed', 'email', 'Email is already in use.')
     uid = next_id()
     # 保存到数据库的user信息passwd进行shar1加密
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    print(user)
-    print(user.passwd, hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest())
-    await User.saveItem(user) # 将注册用户保存到数据库
+    # 检查email和保存用户在同一个连接和事务中完成
+    async with orm.transaction():
+        users = await User.findAll('email=?', [email])
+        if len(users) > 0:
+            raise APIError('rigister:failed', 'email', 'Email is already in use.')
+        await User.saveItem(user) # 将注册用户保存到数据库
     # make session cookie:
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, user2cookie(user, _COOKIE_MAX_AGE), max_age=_COOKIE_MAX_AGE, httponly=True)
     user.passwd = '******' # 将密码变更，数据传输更安全
     r.content_type = 'application/json'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8') # json.dumps序列化一个对象为字符串，另有sort_keys,indent参数来优化字符串格式；json.dump将一个对象序列化存入文件
@@ -229,20 +346,40 @@ async def api_register_user(*, email, name, passwd):
 
 @post('/api/blogs')
 async def api_create_blog(request, *, name, summary, content):
-    print('/api/blogs-----api_create_blog......')
-    check_admin(request)
+    user = await check_admin(request)
     if not name or not name.strip():
         raise APIValueError('name', 'name connot be empty.')
     if not summary or not summary.strip():
         raise APIValueError('summary', 'summary connot be empty.')
     if not content or not content.strip():
         raise APIValueError('content', 'content connot be empty.')
-    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
-    print(blog)
+    blog = Blog(user_id=user.id, user_name=user.name, user_image=user.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     await Blog.saveItem(blog)
+    pages.invalidate('/', '/api/blogs') # 首页和日志列表需要重新生成
+    await markdown_html(blog.content) # 预先渲染, 第一次访问也可以命中缓存
     return blog
 
-@get('/api/blogs/{id}')
+@get('/api/blogs', public=True, cache=True)
+async def api_blogs(*, after=None, size='10'):
+    # 使用游标分页, 翻到多深的页面都和第一页一样只需一次索引定位
+    size = min(get_page_index(size), 100)
+    try:
+        blogs, cursor = await Blog.page(after=after, orderBy='created_at desc', size=size)
+    except ValueError:
+        raise APIValueError('after', 'Invalid page cursor.')
+    return dict(blogs=blogs, next=cursor)
+
+@get('/api/admin/pool')
+async def api_admin_pool(request):
+    await check_admin(request)
+    return dict(pool=orm.pool_stats(), statements=orm.query_stats(), statement_cache=orm.statement_stats(), entity_cache=orm.cache_stats(), markdown=markdown_stats())
+
+@get('/api/admin/indexes')
+async def api_admin_indexes(request):
+    await check_admin(request)
+    return dict(advice=schema.advise(dialect=orm.driver().name))
+
+@get('/api/blogs/{id}', public=True, cache=True)
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
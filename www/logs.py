@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Logging setup. Records are put into a queue by QueueHandler on the event loop thread
+and written by a QueueListener thread, so logging never blocks on the stream.
+'''
+
+__author__ = 'hpt'
+
+import logging, logging.handlers, queue, random, json, atexit
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+class SamplingFilter(logging.Filter):
+    '''
+    Pass only rate (0.0 ~ 1.0) of the records below WARNING.
+    '''
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class JSONFormatter(logging.Formatter):
+    '''
+    Format record as one json object per line.
+    '''
+    def format(self, record):
+        d = dict(time=record.created, level=record.levelname, logger=record.name, message=record.getMessage())
+        if record.exc_info:
+            d['exc'] = self.formatException(record.exc_info)
+        return json.dumps(d, ensure_ascii=False)
+
+def init_logging(level='INFO', format='text', levels=None, sql_sample_rate=1.0, stream=None):
+    '''
+    Init logging of the process, levels is a dict of logger name => level, e.g. {'orm': 'WARNING'}.
+    '''
+    global _listener
+    stop_logging()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter() if format == 'json' else logging.Formatter(TEXT_FORMAT))
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.setLevel(level)
+    for name, lv in (levels or {}).items():
+        logging.getLogger(name).setLevel(lv)
+    # 每条SQL都会记录日志, 负载高时只记录一部分
+    sql_logger = logging.getLogger('orm.sql')
+    for f in sql_logger.filters[:]:
+        sql_logger.removeFilter(f)
+    if sql_sample_rate < 1.0:
+        sql_logger.addFilter(SamplingFilter(sql_sample_rate))
+    _listener = logging.handlers.QueueListener(q, handler)
+    _listener.start()
+
+def after_fork():
+    '''
+    Start the listener thread again in a forked child process, threads do not survive fork.
+    '''
+    global _listener
+    if _listener is not None:
+        # 复制过来的队列中可能有父进程尚未写出的记录, 由父进程负责写出, 子进程换用新的队列
+        q = queue.SimpleQueue()
+        for h in logging.getLogger().handlers:
+            if isinstance(h, logging.handlers.QueueHandler):
+                h.queue = q
+        _listener = logging.handlers.QueueListener(q, *_listener.handlers)
+        _listener.start()
+
+def stop_logging():
+    '''
+    Stop the listener thread after writing out all queued records.
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -15,14 +15,15 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(ttl=60, maxsize=10000) # cookie2user每次请求都会按id查找
     
     id = StringField(primary_key=True, default=next_id, ddl='VARCHAR(50)')
-    email = StringField(ddl='VARCHAR(50)')
+    email = StringField(ddl='VARCHAR(50)', index='unique')
     passwd = StringField(ddl='VARCHAR(50)')
     admin = BooleanField()
     name = StringField(ddl='VARCHAR(50)')
     image = StringField(ddl='VARCHAR(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
     def __init__(self, email, passwd, name, id=next_id(), admin=True, image='favicon.ico', created_at=time.time()):
         self.id = id
         self.email = email
@@ -34,6 +35,7 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(ttl=60, maxsize=10000)
     
     id = StringField(primary_key=True, default=next_id, ddl='VARCHAR(50)')
     user_id = StringField(ddl='VARCHAR(50)')
@@ -41,15 +43,18 @@ class Blog(Model):
     user_image = StringField(ddl='VARCHAR(500)')
     name = StringField(ddl='VARCHAR(50)')
     summary = StringField(ddl='VARCHAR(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='MEDIUMTEXT')
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
+    __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at')] # get_blog按blog_id查找评论并按created_at排序
+
     id = StringField(primary_key=True, default=next_id, ddl='VARCHAR(50)')
     blog_id = StringField(ddl='VARCHAR(50)')
     user_id = StringField(ddl='VARCHAR(50)')
     user_name = StringField(ddl='VARCHAR(50)')
     user_image = StringField(ddl='VARCHAR(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='MEDIUMTEXT')
+    created_at = FloatField(default=time.time, index=True)
 
@@ -44,5 +44,6 @@ CREATE TABLE IF NOT EXISTS comments(
     content MEDIUMTEXT NOT NULL,
     created_at REAL NOT NULL,
     KEY idx_created_at (created_at),
+    KEY idx_blog_id_created_at (blog_id, created_at),
     PRIMARY KEY (id)
 )engine=innodb DEFAULT charset=utf8;
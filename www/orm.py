@@ -1,77 +1,280 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import asyncio, logging
-import aiomysql
+import asyncio, logging, json, base64, contextlib, contextvars, functools, time
 
-# 设置调试级别level,此处为logging.INFO,不设置logging.info()没有任何作用等同于pass
-logging.basicConfig(level=logging.INFO)
+from cache import LRUCache
+from pool import InstrumentedPool
+from drivers import get_driver
+
+logger = logging.getLogger(__name__)
+# 每条SQL语句的日志, 由logs.init_logging()配置采样
+sql_logger = logging.getLogger(__name__ + '.sql')
 
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    sql_logger.info('SQL: %s', sql)
+
+# SQL语句缓存: 保存findAll等拼接出的语句以及'?'到'%s'的占位符转换结果,同一形式的查询只计算一次
+_STATEMENT_CACHE_SIZE = 1024
+_statements = {}
+_statement_stats = dict(hits=0, misses=0)
+
+def cached_sql(key, build):
+    sql = _statements.get(key)
+    if sql is None:
+        _statement_stats['misses'] += 1
+        if len(_statements) >= _STATEMENT_CACHE_SIZE:
+            # where中直接拼接了参数值时,语句形式无限增长,超出上限直接清空
+            _statements.clear()
+        sql = _statements[key] = build()
+    else:
+        _statement_stats['hits'] += 1
+    return sql
+
+def to_mysql_sql(sql):
+    #sql语句的占位符为?,mysql里为%s,做替换
+    return cached_sql(sql, lambda: sql.replace('?', '%s'))
+
+def to_driver_sql(sql):
+    if __driver.placeholder == '?':
+        return sql
+    return to_mysql_sql(sql)
+
+def driver():
+    return __driver
+
+def statement_stats():
+    return dict(_statement_stats, size=len(_statements))
+
+# 每种语句的执行次数和耗时: sql => [count, total seconds, max seconds]
+_query_stats = {}
+
+def observe(sql, seconds):
+    s = _query_stats.get(sql)
+    if s is None:
+        if len(_query_stats) >= _STATEMENT_CACHE_SIZE:
+            _query_stats.clear()
+        s = _query_stats[sql] = [0, 0.0, 0.0]
+    s[0] += 1
+    s[1] += seconds
+    if seconds > s[2]:
+        s[2] = seconds
+
+def query_stats(top=20):
+    'return statements of the most total time, top=None returns all.'
+    L = sorted(_query_stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return [dict(sql=sql, count=c, total_ms=t * 1000, avg_ms=t * 1000 / c, max_ms=m * 1000) for sql, (c, t, m) in L]
+
+def pool_stats():
+    return dict(__pool.stats(), replicas=[p.stats() for p in __replicas])
+
+# 设置了__cache__的Model按主键缓存的命中率等统计
+def cache_stats():
+    return dict((m.__name__, m.cacheStats()) for m in Model.__subclasses__() if m.__cache_backend__ is not None)
+
+__driver = None
+__replicas = [] # 只读副本的连接池
+__replica_select = 'round_robin'
+__next_replica = 0
 
 #创建数据库连接池,可以方便的从连接池中获取数据库连接
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        # 这个必须设置,否则,从数据库获取到的结果是乱码的
-        charset=kw.get('charset', 'utf8'),
-        # 是否自动提交事务,在增删改数据库数据时,如果为True,不需要再commit来提交事务了
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 50),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
-
-async def select(sql, args, size=None):
-    print('select sql----------------------')
-    log(sql, args)
-    
-    global __pool
-    
-    async with __pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            #调用游标的execute()方法来执行sql语句,execute()接收两个参数,第一个为sql语句可以包含占位符,第二个为占位符对应的值,使用该形式可以避免直接使用字符串拼接出来的sql的注入攻击
-            #sql语句的占位符为?,mysql里为%s,做替换
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
+async def create_pool(loop, driver='mysql', replicas=None, replica_select='round_robin', **kw):
+    '''
+    Create pool of the primary database, and pools of replicas if specified. driver is 'mysql' or
+    'sqlite' (db is the database file). replicas is a list of dicts which override kw, e.g.
+    [{'host': '10.0.0.2'}], select() reads from a replica chosen by replica_select: 'round_robin'
+    or 'least_busy'.
+    '''
+    global __pool, __replicas, __replica_select, __driver
+    if replica_select not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica_select: %s' % replica_select)
+    __driver = get_driver(driver)
+    __pool = await _create_pool(loop, **kw)
+    __replicas = [(await _create_pool(loop, **dict(kw, **r))) for r in (replicas or ())]
+    __replica_select = replica_select
+
+async def close_pool():
+    'close pools, the sqlite driver needs it before exit.'
+    for pool in [__pool] + __replicas:
+        pool.close()
+        await pool.wait_closed()
+
+async def _create_pool(loop, **kw):
+    logger.info('create database connection pool to %s:%s/%s...', kw.get('host', 'localhost'), kw.get('port', 3306), kw.get('db'))
+    pool = await __driver.create_pool(loop, **kw)
+    # 统计获取连接的等待时间, 超过acquire_timeout秒取不到连接时直接报错
+    return InstrumentedPool(pool, acquire_timeout=kw.get('acquire_timeout', None), adaptive=kw.get('adaptive', False), adaptive_interval=kw.get('adaptive_interval', 10))
+
+# 当前协程所在的事务, 事务中的语句都在事务的连接上执行
+_transaction = contextvars.ContextVar('transaction', default=None)
+# 写过数据后, 同一个请求(task)中后续的读都从主库读, 避免读到副本中尚未同步的旧数据
+_wrote = contextvars.ContextVar('wrote', default=False)
+
+def read_pool():
+    'pool to read from: a replica, or the primary if there is no replica or current task has written.'
+    global __next_replica
+    if not __replicas or _wrote.get():
+        return __pool
+    if __replica_select == 'least_busy':
+        return min(__replicas, key=lambda p: p.in_use + p.waiting)
+    __next_replica = (__next_replica + 1) % len(__replicas)
+    return __replicas[__next_replica]
+
+def use_primary():
+    'read from the primary in current task from now on.'
+    _wrote.set(True)
+
+@contextlib.asynccontextmanager
+async def connection(read=False):
+    '''
+    Connection of current transaction, or a connection acquired from a replica pool if read
+    is True, otherwise from the primary pool.
+    '''
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx.conn
+        return
+    pool = read_pool() if read else __pool
+    conn = await pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+async def acquire():
+    return (await __pool.acquire())
+
+def release(conn):
+    __pool.release(conn)
+
+class Transaction(object):
+    '''
+    async with transaction(): selects and executes in the block use one connection and are
+    committed together, or rolled back if the block raises. A nested transaction is a savepoint
+    of the outer one. Do not run statements concurrently (e.g. by gather) in one transaction.
+    '''
+    def __init__(self):
+        self.conn = None
+        self.parent = None
+        self.savepoint = None
+        self.invalidations = [] # 事务结束后再清除的实体缓存: [(Model类, 主键), ...]
+
+    async def __aenter__(self):
+        self.parent = _transaction.get()
+        if self.parent is None:
+            self.conn = await acquire()
+            try:
+                await driver().begin(self.conn)
+            except BaseException:
+                release(self.conn)
+                raise
+        else:
+            self.conn = self.parent.conn
+            self.invalidations = self.parent.invalidations # 由最外层事务统一清除
+            self.savepoint = 'sp_%d' % (self.parent.depth() + 1)
+            await self._run('SAVEPOINT %s' % self.savepoint)
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _transaction.reset(self._token)
+        if self.savepoint is not None:
+            # 死锁时数据库已回滚整个事务, savepoint已不存在, 直接抛出原来的异常由外层事务处理
+            if exc_type is not None and driver().rolled_back(exc):
+                return False
+            await self._run(('ROLLBACK TO SAVEPOINT %s' if exc_type else 'RELEASE SAVEPOINT %s') % self.savepoint)
+            return False
+        try:
+            if exc_type is None:
+                await driver().commit(self.conn)
             else:
-                rs = await cur.fetchall()
-            await cur.close()
-    logging.info('rows returned: %s' % len(rs))
+                await driver().rollback(self.conn)
+        finally:
+            release(self.conn)
+            # 提交前其他协程可能又把旧数据读入缓存, 提交或回滚后再清除一次
+            for cls, pk in self.invalidations:
+                cls.invalidate(pk)
+        return False
+
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth() + 1
+
+    async def _run(self, sql):
+        log(sql)
+        await driver().execute(self.conn, sql, ())
+
+def transaction():
+    return Transaction()
+
+def retry_on_deadlock(retries=3, delay=0.05):
+    '''
+    Decorator of coroutine functions which run a transaction, call the function again if the
+    transaction is rolled back by deadlock. Does not retry inside an outer transaction.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kw):
+            for i in range(retries + 1):
+                try:
+                    return (await func(*args, **kw))
+                except Exception as e:
+                    # 由驱动判断是否为死锁等可以重新执行整个事务的错误
+                    if i == retries or not driver().retryable(e) or _transaction.get() is not None:
+                        raise
+                    logger.warning('transaction rolled back by %s, retrying %s...', e, i + 1)
+                    await asyncio.sleep(delay * (2 ** i))
+        return wrapper
+    return decorator
+
+# primary=True时从主库读, 用于需要最新数据的查询, 如填充实体缓存
+async def select(sql, args, size=None, tuples=False, primary=False):
+    log(sql, args)
+    async with connection(read=not primary) as conn:
+        # 由驱动执行语句, 语句包含占位符, 参数单独传入, 可以避免直接使用字符串拼接出来的sql的注入攻击
+        # tuples=True时返回按列顺序的元组, 省去每行构造dict
+        t0 = time.perf_counter()
+        rs = await __driver.query(conn, to_driver_sql(sql), args, size, tuples)
+        observe(sql, time.perf_counter() - t0)
+    logger.debug('rows returned: %s', len(rs))
     # # 如果不关闭__pool，就会报异常：Exception ignored in: <bound method Connection.__del__ of <aiomysql.connection.Connection objec>>
     # __pool.close() # close()is not a coroutine, If you want to wait for actual closing of acquired connection please call wait_closed() after close().
     # await __pool.wait_closed()
     return rs
 
+# 按批返回结果(MySQL使用服务端游标),结果集不会一次全部加载到内存
+async def select_iter(sql, args, batch=500):
+    log(sql, args)
+    async with connection(read=True) as conn:
+        # 提前结束迭代时, 在归还连接前关闭驱动的游标, 否则游标在垃圾回收时才关闭, 连接可能已被其他协程使用或已关闭
+        it = __driver.iterate(conn, to_driver_sql(sql), args, batch)
+        try:
+            async for rs in it:
+                yield rs
+        finally:
+            await it.aclose()
+
+# autocommit=False时语句在单独的事务中执行, 已在事务中时由事务统一提交
 async def execute(sql, args, autocommit=True):
-    print('execute sql----------------------')
+    if not autocommit and _transaction.get() is None:
+        async with transaction():
+            return (await execute(sql, args))
     log(sql)
-    async with __pool.get() as conn:
-        if not autocommit:
-            await conn.begin() # 手动开始事务
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
-                await cur.close()
-            if not autocommit:
-                await conn.commit() # 手动提交事务
-        except BaseException as e:
-            if not autocommit:
-                await conn.rollback() # 出现提交事务异常时恢复原始数据
-            raise e
-    # # 如果不关闭__pool，就会报异常：Exception ignored in: <bound method Connection.__del__ of <aiomysql.connection.Connection objec>>
-    # __pool.close() # close()is not a coroutine, If you want to wait for actual closing of acquired connection please call wait_closed() after close().
-    # await __pool.wait_closed()
-        return affected # 返回被执行的数据记录条数
+    use_primary()
+    async with connection() as conn:
+        t0 = time.perf_counter()
+        affected = await __driver.execute(conn, to_driver_sql(sql), args)
+        observe(sql, time.perf_counter() - t0)
+    return affected # 返回被执行的数据记录条数
+
+async def execute_many(statements):
+    '''
+    Execute [(sql, args), ...] in one transaction, return list of affected rows.
+    '''
+    counts = []
+    async with transaction():
+        for sql, args in statements:
+            counts.append(await execute(sql, args))
+    return counts
 
 def create_args_string(num):
     L = []
@@ -79,48 +282,118 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+# 将值去重后按batch分批, 每批的长度补齐到2的幂(重复最后一个值), in (?, ?...)语句只有少数几种形式, 可以缓存
+def in_chunks(values, batch=500):
+    values = list(dict.fromkeys(values))
+    for i in range(0, len(values), batch):
+        chunk = values[i:i + batch]
+        n = 1
+        while n < len(chunk):
+            n = n * 2
+        n = min(n, batch)
+        yield chunk + [chunk[-1]] * (n - len(chunk))
+
+# 分页游标: 上一页最后一行的(排序字段值, 主键值), 编码为url安全的字符串
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def reject_constant(name):
+    # json默认接受NaN, Infinity, -Infinity, 数据库不接受这些参数
+    raise ValueError('Invalid number: %s' % name)
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'), parse_constant=reject_constant)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    # 值会作为参数传给数据库, 只接受字符串和数字(bool也是int, 需排除)
+    for v in values:
+        if isinstance(v, bool) or not isinstance(v, (str, int, float)):
+            raise ValueError('Invalid cursor: %s' % cursor)
+    return values
+
 class Field(object):
     def __init__(self, name, column_type, primary_key, default):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.lazy = False # 为True时, 列表查询可以延迟加载该列
+        self.index = False # True为该列建立索引, 'unique'为唯一索引
         
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='VARCHAR(100)'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='VARCHAR(100)', index=False):
         super(StringField, self).__init__(name, ddl, primary_key, default)
+        self.index = index
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
+    def __init__(self, name=None, default=False, index=False):
         super().__init__(name, 'boolean', False, default)
+        self.index = index
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
         super().__init__(name, 'bigint', primary_key, default)
+        self.index = index
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
         super().__init__(name, 'real', primary_key, default)
+        self.index = index
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, lazy=True, ddl='text'):
+        super().__init__(name, ddl, False, default)
+        self.lazy = lazy
+
+class Record(object):
+    '''
+    Base class of the slotted row classes generated for every model, see Model.findRecords().
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % item for item in self._asdict().items()))
+
+def make_record_class(name, columns):
+    # 与namedtuple类似, 生成按位置参数直接赋值的__init__, 比循环setattr快很多
+    source = 'def __init__(_self, %s):\n    %s\n' % (', '.join(columns), '\n    '.join('_self.%s = %s' % (c, c) for c in columns))
+    namespace = {}
+    exec(source, namespace)
+    return type(name, (Record,), dict(__slots__=tuple(columns), __init__=namespace['__init__']))
 
 class ModelMetaclass(type):
     def __new__(cls, name, bases, attrs):
         if name=='Model':
             return type.__new__(cls, name, bases, attrs)
         tableName = attrs.get('__table__', None) or name
-        logging.info('found model: %s (table: %s)' % (name, tableName))
+        logger.info('found model: %s (table: %s)', name, tableName)
         mappings = dict() 		# key-value对
         fields = [] 					# 保存主键外的字段
         primaryKey = None 		# 用来标记唯一的主键
         for k, v in attrs.items():
             if isinstance(v, Field):
-                logging.info('  found mapping: %s ==> %s' % (k, v))
+                logger.info('  found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 if v.primary_key:
                     # 找到主键
@@ -138,16 +411,40 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
+        attrs['__lazy_fields__'] = [f for f in fields if mappings[f].lazy]
+        # 索引: (名称, 列, 是否唯一), 单列索引由Field的index参数声明, 多列索引由__indexes__ = [('col1', 'col2'), ...]声明
+        indexes = [(f,) for f in fields if mappings[f].index] + [tuple(cols) for cols in attrs.get('__indexes__', ())]
+        for cols in indexes:
+            for f in cols:
+                if f not in mappings:
+                    raise BaseException('Invalid index field: %s' % f)
+        attrs['__indexes__'] = [('idx_%s' % '_'.join(cols), cols, len(cols) == 1 and mappings[cols[0]].index == 'unique') for cols in indexes]
         # 以下四种方法保存了默认了增删改查操作,其中添加的反引号``,是为了避免与sql关键字冲突的,否则sql语句会执行出错
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         # insert into table (key1, key2...) values(?, ?...), ?后续用参数替代
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values(%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        # 多行插入时追加的values行: , (?, ?...)
+        attrs['__insert_row__'] = ', (%s)' % create_args_string(len(escaped_fields) + 1)
         # update table set key1=?, key2=?,..., where primaryKey=?
         attrs['__update__'] = 'update `%s` set ? where `%s`=?' % (tableName, primaryKey) # set参数使用传入值设置
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+        # 与__select__列顺序一致的__slots__行对象类
+        attrs['__record__'] = make_record_class('%sRecord' % name, [primaryKey] + fields)
+        # 按主键缓存find结果: __cache__ = dict(ttl=60, maxsize=10000), 或dict(backend=...)指定其他缓存后端
+        cache = attrs.get('__cache__', None)
+        if cache:
+            attrs['__cache_backend__'] = cache.get('backend', None) or LRUCache(maxsize=cache.get('maxsize', 10000), ttl=cache.get('ttl', 60))
+        else:
+            attrs['__cache_backend__'] = None
+        # 正在执行的find: 主键 => [查询数, 版本号], invalidate时版本号加1
+        attrs['__cache_pending__'] = {}
         return type.__new__(cls, name, bases, attrs)
 
 class Model(dict, metaclass=ModelMetaclass):
+    _deferred = frozenset() # 查询时未加载的字段, 需await load()后才能访问
+    _original = None # 从数据库加载时的数据行, save()时只更新与其不同的字段
+
     def __init__(self, **kw):
         super().__init__(**kw) # 古老写法super(Model, self).__init__(**kw)
     
@@ -155,6 +452,8 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(r"'%s' is deferred, call 'await obj.load()' first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -170,91 +469,388 @@ class Model(dict, metaclass=ModelMetaclass):
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s: %s' % (key, str(value)))
+                logger.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
     
     # find
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        'find objects by where clause.'
-        sql = [cls.__select__]
+    def projection(cls, only=None, defer=None):
+        'return (selected fields or None for all, deferred fields), defer=True defers all lazy fields.'
+        if only is None and not defer:
+            return None, frozenset()
+        if defer is True:
+            defer = cls.__lazy_fields__
+        defer = defer or ()
+        for f in list(only or ()) + list(defer):
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        fields = tuple(f for f in cls.__fields__ if (only is None or f in only) and f not in defer)
+        return fields, frozenset(f for f in cls.__fields__ if f not in fields)
+
+    @classmethod
+    def fromRow(cls, row, deferred=frozenset()):
+        # 不调用__init__: 子类的__init__可能有必需参数(如User), 只查询部分字段时无法传入
+        obj = cls.__new__(cls)
+        dict.update(obj, row)
+        # 直接写入实例__dict__, 不作为dict的key, 不会被json序列化
+        object.__setattr__(obj, '_original', row)
+        if deferred:
+            object.__setattr__(obj, '_deferred', deferred)
+        return obj
+
+    @classmethod
+    def selectSql(cls, where=None, orderBy=None, limit=None, fields=None):
+        'build select sql, limit is None, int or (offset, count) tuple, fields is None for all fields.'
+        if fields is None:
+            sql = [cls.__select__]
+        else:
+            sql = ['select %s from `%s`' % (', '.join('`%s`' % f for f in (cls.__primary_key__,) + tuple(fields)), cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args=[]
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kw.get('limit', None)
         if limit is not None:
             sql.append('limit')
             if isinstance(limit, int):
                 sql.append('?')
-                args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
                 sql.append('?, ?')
-                args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql)
+
+    @classmethod
+    def findAllSql(cls, where=None, args=None, **kw):
+        'return (sql, args, deferred fields) of findAll.'
+        args = [] if args is None else list(args)
+        fields, deferred = cls.projection(kw.get('only', None), kw.get('defer', None))
+        orderBy = kw.get('orderBy', None)
+        limit = kw.get('limit', None)
+        if isinstance(limit, int):
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            args.extend(limit)
+        elif limit is not None:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        # 语句只与查询形式有关, limit的值作为参数传入
+        sql = cached_sql((cls, where, orderBy, type(limit), fields), lambda: cls.selectSql(where, orderBy, limit, fields))
+        return sql, args, deferred
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        'find objects by where clause, only=[...] or defer=[...]/True selects part of the fields.'
+        sql, args, deferred = cls.findAllSql(where, args, **kw)
+        rs = await select(sql, args)
+        return [cls.fromRow(r, deferred) for r in rs]
+
+    @classmethod
+    async def findRecords(cls, where=None, args=None, **kw):
+        'find rows as __slots__ record objects built from tuple rows, use for read only listings.'
+        if kw.get('only', None) is not None or kw.get('defer', None):
+            raise ValueError('findRecords() always selects all fields.')
+        sql, args, deferred = cls.findAllSql(where, args, **kw)
+        rs = await select(sql, args, tuples=True)
+        record = cls.__record__
+        return [record(*r) for r in rs]
+
+    @classmethod
+    async def iterAll(cls, where=None, args=None, batch=500, **kw):
+        'iterate objects by where clause, fetch batch rows at a time from a server side cursor.'
+        sql, args, deferred = cls.findAllSql(where, args, **kw)
+        async for rs in select_iter(sql, args, batch):
+            for r in rs:
+                yield cls.fromRow(r, deferred)
     
+    @classmethod
+    async def page(cls, where=None, args=None, after=None, orderBy='created_at desc', size=10, only=None, defer=True):
+        'keyset pagination by (orderBy column, primary key), return (objects, cursor of next page or None), lazy fields are deferred by default.'
+        if size < 1:
+            raise ValueError('Invalid page size: %s' % size)
+        fields, deferred = cls.projection(only, defer)
+        L = orderBy.split()
+        column = L[0].strip('`')
+        desc = len(L) > 1 and L[1].lower() == 'desc'
+        args = [] if args is None else list(args)
+        if after:
+            # where (created_at, id) < (?, ?), 利用索引直接定位, 不需要扫描跳过offset行
+            args.extend(decode_cursor(after))
+        args.append(size + 1) # 多取一行, 判断是否还有下一页
+        sql = cached_sql((cls, 'page', where, orderBy, bool(after), fields), lambda: cls.pageSql(where, column, desc, bool(after), fields))
+        rs = await select(sql, args)
+        items = [cls.fromRow(r, deferred) for r in rs[:size]]
+        cursor = None
+        if len(rs) > size:
+            last = items[-1]
+            cursor = encode_cursor([last[column], last[cls.__primary_key__]])
+        return items, cursor
+
+    @classmethod
+    def pageSql(cls, where, column, desc, after, fields=None):
+        pk = cls.__primary_key__
+        conditions = ['(%s)' % where] if where else []
+        if after:
+            conditions.append('(`%s`, `%s`) %s (?, ?)' % (column, pk, '<' if desc else '>'))
+        order = 'desc' if desc else 'asc'
+        return cls.selectSql(' and '.join(conditions), '`%s` %s, `%s` %s' % (column, order, pk, order), 1, fields)
+
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
         'find number by select and where.'
+        sql = cached_sql((cls, 'findNumber', selectField, where), lambda: cls.numberSql(selectField, where))
+        rs = await select(sql, args, 1)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
+    @classmethod
+    def numberSql(cls, selectField, where=None):
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        return ' '.join(sql)
     
     @classmethod
-    async def find(cls, pk):
+    async def loadFor(cls, parents, key, attr=None, parentKey=None, batch=500, **kw):
+        '''
+        Load objects of which key equals parentKey (primary key by default) of parents by batched
+        "key in (...)" queries, set the list to attr (table name by default) of each parent and
+        return dict of parent key => objects. kw is passed to findAll, e.g. orderBy or defer.
+        '''
+        parents = list(parents)
+        if not parents:
+            return dict()
+        attr = attr or cls.__table__
+        parentKey = parentKey or parents[0].__primary_key__
+        only = kw.get('only', None)
+        if only is not None and key not in only:
+            kw['only'] = tuple(only) + (key,)
+        values = [p.getValue(parentKey) for p in parents]
+        children = {v: [] for v in values}
+        for chunk in in_chunks(values, batch):
+            for obj in await cls.findAll('`%s` in (%s)' % (key, create_args_string(len(chunk))), chunk, **kw):
+                children[obj[key]].append(obj)
+        for p, v in zip(parents, values):
+            setattr(p, attr, children[v])
+        return children
+
+    @classmethod
+    async def countFor(cls, parents, key, attr=None, parentKey=None, where=None, args=None, batch=500):
+        '''
+        Count objects of each parent by batched "key in (...) group by key" queries, set the number
+        to attr (table name + '_count' by default) of each parent and return dict of parent key => number.
+        '''
+        parents = list(parents)
+        if not parents:
+            return dict()
+        attr = attr or '%s_count' % cls.__table__
+        parentKey = parentKey or parents[0].__primary_key__
+        values = [p.getValue(parentKey) for p in parents]
+        counts = dict.fromkeys(values, 0)
+        for chunk in in_chunks(values, batch):
+            sql = cached_sql((cls, 'countFor', key, where, len(chunk)), lambda: cls.countForSql(key, len(chunk), where))
+            rs = await select(sql, list(chunk) + list(args or ()))
+            for r in rs:
+                counts[r['_key_']] = r['_num_']
+        for p, v in zip(parents, values):
+            setattr(p, attr, counts[v])
+        return counts
+
+    @classmethod
+    def countForSql(cls, key, n, where=None):
+        sql = ['select `%s` _key_, count(*) _num_ from `%s` where `%s` in (%s)' % (key, cls.__table__, key, create_args_string(n))]
+        if where:
+            sql.append('and (%s)' % where)
+        sql.append('group by `%s`' % key)
+        return ' '.join(sql)
+
+    @classmethod
+    async def find(cls, pk, only=None, defer=None):
         'find object primary key.'
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        backend = cls.__cache_backend__
+        if backend is not None:
+            r = backend.get(pk)
+            if r is not None:
+                return cls.fromRow(r) # 缓存的是数据行, 每次返回新的对象, 修改对象不会影响缓存
+        fields, deferred = cls.projection(only, defer)
+        if fields is None:
+            sql = cls.__find__
+        else:
+            sql = cached_sql((cls, 'find', fields), lambda: cls.selectSql('`%s`=?' % cls.__primary_key__, fields=fields))
+        # 放入缓存的数据从主库读, 副本中可能是尚未同步的旧数据, 缓存后会在ttl内一直返回旧数据
+        cacheable = not deferred and backend is not None
+        if not cacheable:
+            rs = await select(sql, [pk], 1)
+        else:
+            pending = cls.__cache_pending__.setdefault(pk, [0, 0])
+            pending[0] += 1
+            generation = pending[1]
+            try:
+                rs = await select(sql, [pk], 1, primary=True)
+            finally:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    del cls.__cache_pending__[pk]
+            # 查询期间被invalidate过的数据可能已过时; 事务中读到的可能是未提交的数据, 都不放入缓存
+            cacheable = pending[1] == generation and _transaction.get() is None
+        if len(rs) == 0:
+            return None
+        if cacheable:
+            backend.set(pk, rs[0])
+        return cls.fromRow(rs[0], deferred)
+
+    async def load(self, *fields):
+        'load deferred fields (all deferred fields if not specified) of this object.'
+        fields = tuple(fields or sorted(self._deferred))
+        if not fields:
+            return self
+        cls = self.__class__
+        sql = cached_sql((cls, 'load', fields), lambda: 'select %s from `%s` where `%s`=?' % (', '.join('`%s`' % f for f in fields), cls.__table__, cls.__primary_key__))
+        rs = await select(sql, [self.getValue(cls.__primary_key__)], 1)
         if len(rs) == 0:
+            raise ValueError('Object not found: %s' % self.getValue(cls.__primary_key__))
+        dict.update(self, rs[0]) # Model.update为类方法, 这里需调用dict.update
+        object.__setattr__(self, '_original', dict(self._original or (), **rs[0]))
+        object.__setattr__(self, '_deferred', self._deferred.difference(fields))
+        return self
+
+    def changedFields(self):
+        'return fields changed since loaded from database, or all fields set if the object is not loaded.'
+        original = self._original
+        if original is None:
+            return [f for f in self.__fields__ if f in self]
+        return [f for f in self.__fields__ if f in self and (f not in original or self[f] != original[f])]
+
+    async def save(self):
+        '''
+        Insert the object if it is not loaded from database, otherwise update changed fields only,
+        no statement is executed if nothing changed. Return affected rows.
+        '''
+        cls = self.__class__
+        if self._original is None:
+            rows = await cls.saveItem(self)
+        else:
+            fields = self.changedFields()
+            if not fields:
+                return 0
+            rows = await cls.update(self.getValue(cls.__primary_key__), **{f: self[f] for f in fields})
+        object.__setattr__(self, '_original', dict(self))
+        return rows
+
+    @classmethod
+    def invalidate(cls, pk):
+        'remove cached object by primary key, again after current transaction (if any) ends.'
+        backend = cls.__cache_backend__
+        if backend is None:
+            return
+        backend.delete(pk)
+        # 正在查询该主键的find读到的可能是修改前的数据, 增加版本号使其不放入缓存
+        pending = cls.__cache_pending__.get(pk)
+        if pending is not None:
+            pending[1] += 1
+        tx = _transaction.get()
+        if tx is not None:
+            tx.invalidations.append((cls, pk))
+
+    @classmethod
+    def cacheStats(cls):
+        if cls.__cache_backend__ is None:
             return None
-        return cls(**rs[0])
+        return cls.__cache_backend__.stats()
     
     # insert
     @classmethod
     async def saveItem(cls, item):
+        if item._deferred:
+            raise ValueError('Cannot save object with deferred fields: %s' % ', '.join(sorted(item._deferred)))
         args = list(map(item.getValueOrDefault, item.__fields__))
         args.append(item.getValueOrDefault(item.__primary_key__))
         rows = await execute(cls.__insert__, args)
+        cls.invalidate(args[-1])
         if rows != 1:
-            logging.warn('failed to insert record: affected rows: %s' % rows)
+            logger.warning('failed to insert record: affected rows: %s', rows)
+        return rows
+
+    @classmethod
+    async def saveMany(cls, items, chunk_size=500):
+        'insert objects by multi-row insert, one statement and one transaction per chunk.'
+        items = list(items)
+        counts = []
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            args = []
+            for item in chunk:
+                args.extend(map(item.getValueOrDefault, cls.__fields__))
+                args.append(item.getValueOrDefault(cls.__primary_key__))
+            # insert into table (key1, key2...) values(?, ?...), (?, ?...)...
+            sql = cls.__insert__ + cls.__insert_row__ * (len(chunk) - 1)
+            rows = await execute(sql, args, autocommit=False)
+            for item in chunk:
+                cls.invalidate(item.getValue(cls.__primary_key__))
+            if rows != len(chunk):
+                logger.warning('failed to insert records: affected rows: %s of %s', rows, len(chunk))
+            counts.append(rows)
+        return counts
     
     # update
+    @classmethod
+    def updateSql(cls, fields):
+        'return (sql, fields) of updating fields by primary key, statement is cached by the set of fields.'
+        fields = tuple(sorted(fields))
+        if not fields:
+            raise ValueError('No field to update.')
+        for f in fields:
+            if f not in cls.__fields__:
+                raise ValueError('Invalid field: %s' % f)
+        # 'update `%s` set ? where `%s`=?' 将第一个问号替换为 `key1`=?, `key2`=?...
+        sql = cached_sql((cls, 'update', fields), lambda: cls.__update__.replace('?', ', '.join('`%s`=?' % f for f in fields), 1))
+        return sql, fields
+
     @classmethod
     async def update(cls, pk, **kw):
-        #sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda item: '`%s`="%s"' % (item[0], item[1]), kw.items())), cls.__primary_key__) # `%s`="%s" value突出为字符串表示
-        # 'update `%s` set ? where `%s`=?' 将第一个问号用kw参数替代
-        sql = cls.__update__.replace('?', ', '.join(map(lambda item: '`%s`="%s"' % (item[0], item[1]), kw.items())), 1)
-        rows = await execute(sql, pk)
+        'update fields of kw by primary key, return affected rows.'
+        sql, fields = cls.updateSql(kw.keys())
+        args = [kw[f] for f in fields]
+        args.append(pk)
+        rows = await execute(sql, args)
+        cls.invalidate(pk)
         if rows != 1:
-            logging.warn('failed to update by primary key: affected rows: %s' % rows)
+            logger.warning('failed to update by primary key: affected rows: %s', rows)
+        return rows
+
+    @classmethod
+    async def updateMany(cls, changes):
+        'update [(pk, dict of fields), ...] in one transaction, return list of affected rows.'
+        changes = list(changes)
+        statements = []
+        for pk, kw in changes:
+            sql, fields = cls.updateSql(kw.keys())
+            statements.append((sql, [kw[f] for f in fields] + [pk]))
+        counts = await execute_many(statements)
+        for pk, kw in changes:
+            cls.invalidate(pk)
+        return counts
     
     # remove
     @classmethod
     async def remove(cls, pk):
         #args = list(map(self.getValueOrDefault, self.__fields__))
-        rows = await execute(cls.__delete__, pk)
+        rows = await execute(cls.__delete__, [pk])
+        cls.invalidate(pk)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+            logger.warning('failed to remove by primary key: affected rows: %s', rows)
 
     @classmethod
     async def removeItem(cls, item):
         #print('+++++++++++++++++', item.__primary_key__)
-        rows = await execute(cls.__delete__, item.getValue(item.__primary_key__))
+        pk = item.getValue(item.__primary_key__)
+        rows = await execute(cls.__delete__, [pk])
+        cls.invalidate(pk)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+            logger.warning('failed to remove by primary key: affected rows: %s', rows)
 
 '''
 ####################################################################
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Instrumented connection pool. Wraps a driver pool, measures how long acquiring a
+connection waits, counts connections in use, fails fast when no connection is
+available in time, and optionally adapts minsize to the observed concurrency.
+'''
+
+__author__ = 'hpt'
+
+import asyncio, time, logging, bisect
+
+logger = logging.getLogger(__name__)
+
+class PoolTimeoutError(Exception):
+    pass
+
+class Histogram(object):
+    '''
+    Counts of observed values (seconds) by upper bounds in milliseconds.
+    '''
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # 最后一个为超出最大上限的次数
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        'upper bound (ms) of the bucket which contains the p (0.0 ~ 1.0) percentile.'
+        if not self.count:
+            return 0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= self.count * p:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def stats(self):
+        buckets = dict(('le_%s' % b, c) for b, c in zip(self.bounds, self.counts))
+        buckets['inf'] = self.counts[-1]
+        return dict(count=self.count, avg_ms=self.total / self.count if self.count else 0.0, max_ms=self.max, p50_ms=self.percentile(0.5), p99_ms=self.percentile(0.99), buckets=buckets)
+
+class InstrumentedPool(object):
+    '''
+    Wrap a driver pool which has acquire(), release(conn), shrink(target), size, freesize, minsize and maxsize.
+    acquire_timeout (seconds) raises PoolTimeoutError instead of waiting forever, adaptive=True
+    sets minsize every adaptive_interval seconds to the peak of connections in use.
+    '''
+    def __init__(self, pool, acquire_timeout=None, adaptive=False, adaptive_interval=10):
+        self._pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.adaptive = adaptive
+        self.adaptive_interval = adaptive_interval
+        self.min_minsize = pool.minsize # 自适应时minsize不低于配置值
+        self.wait = Histogram()
+        self.in_use = 0
+        self.waiting = 0
+        self.peak = 0 # 当前周期内同时使用的连接数峰值
+        self.timeouts = 0
+        self._adapter = None
+        if adaptive:
+            self._adapter = asyncio.ensure_future(self.adapt())
+
+    @property
+    def minsize(self):
+        return self._pool.minsize
+
+    @property
+    def maxsize(self):
+        return self._pool.maxsize
+
+    async def acquire(self):
+        t0 = time.perf_counter()
+        self.waiting += 1
+        try:
+            if self.acquire_timeout is None:
+                conn = await self._pool.acquire()
+            else:
+                conn = await asyncio.wait_for(self._pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolTimeoutError('No database connection available in %s seconds, %s in use.' % (self.acquire_timeout, self.in_use))
+        finally:
+            self.waiting -= 1
+            self.wait.observe(time.perf_counter() - t0)
+        self.in_use += 1
+        if self.in_use > self.peak:
+            self.peak = self.in_use
+        return conn
+
+    def release(self, conn):
+        self.in_use -= 1
+        return self._pool.release(conn)
+
+    async def adapt(self):
+        while True:
+            await asyncio.sleep(self.adaptive_interval)
+            try:
+                await self.resize()
+            except Exception as e:
+                logger.exception(e)
+
+    async def resize(self):
+        # 以上一周期的并发峰值作为minsize, 空闲连接多于minsize时关闭多余的空闲连接
+        target = min(max(self.min_minsize, self.peak), self.maxsize)
+        self.peak = self.in_use
+        pool = self._pool
+        if target == pool.minsize:
+            return
+        logger.info('resize pool minsize: %s => %s', pool.minsize, target)
+        await pool.shrink(target)
+
+    def close(self):
+        if self._adapter is not None:
+            self._adapter.cancel()
+        self._pool.close()
+
+    async def wait_closed(self):
+        await self._pool.wait_closed()
+
+    def stats(self):
+        return dict(size=self._pool.size, free=self._pool.freesize, in_use=self.in_use, waiting=self.waiting, minsize=self.minsize, maxsize=self.maxsize, timeouts=self.timeouts, acquire_wait=self.wait.stats())
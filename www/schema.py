@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Schema tool. Generates DDL from the __mappings__ and __indexes__ of models, compares
+it with the schema of the database in config, and advises indexes for the queries
+recorded by orm which filter or sort by columns without an index.
+
+python schema.py ddl [mysql|sqlite]   print DDL of all models
+python schema.py diff                 print differences between models and database, with fixes
+python schema.py create               create missing tables and indexes
+'''
+
+__author__ = 'hpt'
+
+import asyncio, re, sys
+
+import orm
+from orm import Model
+from config import configs
+import models
+
+def all_models():
+    return sorted(Model.__subclasses__(), key=lambda m: m.__table__)
+
+def columns_sql(cols):
+    return ', '.join('`%s`' % c for c in cols)
+
+def column_sql(model, f):
+    return '`%s` %s NOT NULL' % (f, model.__mappings__[f].column_type)
+
+def create_index_sql(model, index, dialect='mysql'):
+    name, cols, unique = index
+    if dialect == 'mysql':
+        return 'ALTER TABLE `%s` ADD %sKEY `%s` (%s);' % (model.__table__, 'UNIQUE ' if unique else '', name, columns_sql(cols))
+    # sqlite的索引名在整个数据库中唯一, 加上表名
+    return 'CREATE %sINDEX IF NOT EXISTS `%s_%s` ON `%s` (%s);' % ('UNIQUE ' if unique else '', model.__table__, name, model.__table__, columns_sql(cols))
+
+def create_table_sql(model, dialect='mysql'):
+    'return list of statements which create table and indexes of model.'
+    lines = [column_sql(model, f) for f in [model.__primary_key__] + model.__fields__]
+    if dialect == 'mysql':
+        lines.extend('%sKEY `%s` (%s)' % ('UNIQUE ' if unique else '', name, columns_sql(cols)) for name, cols, unique in model.__indexes__)
+    lines.append('PRIMARY KEY (`%s`)' % model.__primary_key__)
+    sql = 'CREATE TABLE IF NOT EXISTS `%s` (\n    %s\n)' % (model.__table__, ',\n    '.join(lines))
+    if dialect == 'mysql':
+        return [sql + ' engine=innodb DEFAULT charset=utf8;']
+    return [sql + ';'] + [create_index_sql(model, index, dialect) for index in model.__indexes__]
+
+def ddl(dialect='mysql'):
+    return '\n\n'.join('\n'.join(create_table_sql(m, dialect)) for m in all_models())
+
+# 数据库返回的类型与Field的ddl写法不同, 比较前统一
+_TYPE_ALIASES = {'boolean': 'tinyint(1)', 'bool': 'tinyint(1)', 'real': 'double', 'integer': 'bigint'}
+
+def normalize_type(t):
+    t = t.lower().replace(' ', '')
+    t = _TYPE_ALIASES.get(t, t)
+    # MySQL 5.7返回bigint(20), 8.0返回bigint
+    return re.sub(r'^(smallint|mediumint|int|bigint)\(\d+\)', r'\1', t)
+
+def diff(model, described, dialect='mysql'):
+    '''
+    Compare model with described (columns, indexes) of its table, return list of (message, fix sql or None).
+    '''
+    table = model.__table__
+    if described is None:
+        return [('table %s does not exist' % table, '\n'.join(create_table_sql(model, dialect)))]
+    columns, indexes = described
+    result = []
+    for f in [model.__primary_key__] + model.__fields__:
+        if f not in columns:
+            # sqlite不能添加没有默认值的NOT NULL列
+            fix = 'ALTER TABLE `%s` ADD COLUMN %s;' % (table, column_sql(model, f) if dialect == 'mysql' else '`%s` %s' % (f, model.__mappings__[f].column_type))
+            result.append(('%s.%s is missing' % (table, f), fix))
+        elif normalize_type(columns[f]) != normalize_type(model.__mappings__[f].column_type):
+            fix = 'ALTER TABLE `%s` MODIFY %s;' % (table, column_sql(model, f)) if dialect == 'mysql' else None
+            result.append(('%s.%s is %s, model declares %s' % (table, f, columns[f], model.__mappings__[f].column_type), fix))
+    for c in columns:
+        if c not in model.__mappings__:
+            result.append(('%s.%s is not in model' % (table, c), None))
+    # 按列和是否唯一比较索引, 不比较名称
+    existing = set((tuple(cols), unique) for name, cols, unique in indexes)
+    declared = set((tuple(cols), unique) for name, cols, unique in model.__indexes__)
+    for index in model.__indexes__:
+        if (tuple(index[1]), index[2]) not in existing:
+            result.append(('index %s (%s) of %s is missing' % (index[0], ', '.join(index[1]), table), create_index_sql(model, index, dialect)))
+    for name, cols, unique in indexes:
+        if (tuple(cols), unique) not in declared:
+            result.append(('index %s (%s) of %s is not in model' % (name, ', '.join(cols), table), None))
+    return result
+
+async def describe(model):
+    async with orm.connection() as conn:
+        return (await orm.driver().describe(conn, model.__table__))
+
+async def diff_database():
+    result = []
+    for m in all_models():
+        result.extend(diff(m, await describe(m), orm.driver().name))
+    return result
+
+_RE_TABLE = re.compile(r'^\s*(?:select\b.*?\bfrom|update|delete\s+from)\s+`?(\w+)`?', re.I | re.S)
+_RE_WHERE = re.compile(r'\bwhere\b(.*?)(?:\bgroup\s+by\b|\border\s+by\b|\blimit\b|$)', re.I | re.S)
+_RE_ORDER = re.compile(r'\border\s+by\b(.*?)(?:\blimit\b|$)', re.I | re.S)
+_RE_NAME = re.compile(r'[A-Za-z_]\w*')
+
+def query_columns(sql, model):
+    'return (columns in where, columns in order by) of sql which are fields of model.'
+    def names(m):
+        if m is None:
+            return []
+        L = []
+        for name in _RE_NAME.findall(m.group(1)):
+            if name in model.__mappings__ and name not in L:
+                L.append(name)
+        return L
+    return names(_RE_WHERE.search(sql)), names(_RE_ORDER.search(sql))
+
+def advise(stats=None, dialect='mysql'):
+    '''
+    Return queries recorded by orm (orm.query_stats()) which filter or sort by columns
+    that are not the leading column of any index declared by models, with the index to create.
+    Use diff to check the declared indexes exist in the database.
+    '''
+    tables = dict((m.__table__, m) for m in all_models())
+    result = []
+    for s in (orm.query_stats(top=None) if stats is None else stats):
+        m = _RE_TABLE.match(s['sql'])
+        model = tables.get(m.group(1)) if m else None
+        if model is None:
+            continue
+        where, order = query_columns(s['sql'], model)
+        # 有where时索引用于过滤, 否则用于排序
+        columns = where or order
+        if not columns:
+            continue
+        leading = set([model.__primary_key__] + [cols[0] for name, cols, unique in model.__indexes__])
+        if any(c in leading for c in columns):
+            continue
+        cols = tuple(where + [c for c in order if c not in where])
+        index = ('idx_%s' % '_'.join(cols), cols, False)
+        result.append(dict(sql=s['sql'], count=s['count'], total_ms=s['total_ms'], table=model.__table__, columns=cols, fix=create_index_sql(model, index, dialect)))
+    return result
+
+async def main(loop, cmd):
+    await orm.create_pool(loop=loop, **configs.database)
+    try:
+        if cmd == 'diff':
+            result = await diff_database()
+            for message, fix in result:
+                print('-- %s' % message)
+                if fix:
+                    print(fix)
+            if not result:
+                print('-- schema is up to date.')
+        elif cmd == 'create':
+            for m in all_models():
+                for sql in create_table_sql(m, orm.driver().name):
+                    await orm.execute(sql, [])
+        else:
+            raise ValueError('Invalid command: %s' % cmd)
+    finally:
+        await orm.close_pool()
+
+if __name__ == '__main__':
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'ddl'
+    if cmd == 'ddl':
+        print(ddl(sys.argv[2] if len(sys.argv) > 2 else configs.database.driver))
+    else:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main(loop, cmd))
+        loop.close()
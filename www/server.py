@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Multi-process launcher. The master process forks workers, every worker runs its own
+event loop and database pool and accepts connections on the same port, either binding
+it with SO_REUSEPORT or sharing a listening socket inherited from the master.
+'''
+
+__author__ = 'hpt'
+
+import asyncio, os, sys, signal, socket, selectors, json, time, logging, resource, collections
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+'''
+run()的参数：
+init(loop, sock) 协程，在worker中创建数据库连接池和web服务，返回(server, handler)，sock为None时自行绑定端口
+health() 返回worker的状态dict，worker每health_interval秒通过管道报告给master
+'''
+def run(init, host='127.0.0.1', port=9000, workers=1, reuse_port=True, health=None, health_interval=10, shutdown_timeout=30, loop='asyncio'):
+    # 在fork之前设置, worker继承事件循环策略
+    install_loop_policy(loop)
+    if workers <= 1:
+        # 单进程，与原来一样直接在当前进程运行
+        run_worker(init, None, None, health, health_interval, shutdown_timeout)
+        return
+    Master(init, host, port, workers, reuse_port, health, health_interval, shutdown_timeout).run()
+
+'''
+事件循环实现：
+asyncio  标准库默认的事件循环
+uvloop   基于libuv的事件循环，需要pip install uvloop
+auto     已安装uvloop时使用uvloop，否则使用asyncio
+'''
+def install_loop_policy(name):
+    if name not in ('asyncio', 'uvloop', 'auto'):
+        raise ValueError('Invalid event loop: %s' % name)
+    if name == 'asyncio':
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            logger.warning('uvloop is not installed, using asyncio event loop.')
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info('using uvloop %s event loop.', uvloop.__version__)
+    return 'uvloop'
+
+def bind_socket(host, port, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(init, sock, health_fd, health, health_interval, shutdown_timeout):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    srv, handler = loop.run_until_complete(init(loop, sock))
+    started_at = time.time()
+
+    async def report_health():
+        while True:
+            d = dict(pid=os.getpid(), uptime=int(time.time() - started_at), rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            if health is not None:
+                d.update(health())
+            os.write(health_fd, (json.dumps(d) + '\n').encode('utf-8'))
+            await asyncio.sleep(health_interval)
+
+    if health_fd is not None:
+        reporter = asyncio.ensure_future(report_health())
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
+    loop.run_forever()
+    # 优雅退出：不再接受新连接，等待正在处理的请求完成
+    logger.info('worker %s shutting down...', os.getpid())
+    if health_fd is not None:
+        reporter.cancel()
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(handler.shutdown(shutdown_timeout))
+    loop.close()
+
+class Master(object):
+    '''
+    Fork and supervise workers: restart workers which exit or stop reporting health,
+    SIGHUP starts a new set of workers and then stops the old ones, SIGTERM/SIGINT stops all.
+    A worker which keeps exiting is restarted with exponential backoff, the master stops
+    when a worker exits MAX_FAILURES times in FAILURE_WINDOW seconds, e.g. init fails.
+    '''
+    RESPAWN_DELAY = 0.5
+    RESPAWN_MAX_DELAY = 30
+    MAX_FAILURES = 5
+    FAILURE_WINDOW = 60
+
+    def __init__(self, init, host, port, workers, reuse_port, health, health_interval, shutdown_timeout):
+        self.init = init
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.health = health
+        self.health_interval = health_interval
+        self.shutdown_timeout = shutdown_timeout
+        # 不使用SO_REUSEPORT时，由master绑定端口，worker继承监听socket
+        self.sock = None if reuse_port else bind_socket(host, port, False)
+        self.children = dict() # pid => [read fd of health pipe, last report time, unfinished line]
+        self.slots = dict() # pid => 第几个worker
+        self.failures = [collections.deque() for i in range(workers)] # 每个worker最近退出的时间
+        self.pending = dict() # 等待重新启动的worker => 启动时间
+        self.failed = False
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+        self.restarting = False
+
+    def spawn(self, slot):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            logs.after_fork()
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(self.init, self.sock, w, self.health, self.health_interval, self.shutdown_timeout)
+            except BaseException as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                logs.stop_logging() # os._exit不会执行atexit, 先写出日志
+                os._exit(code)
+        os.close(w)
+        os.set_blocking(r, False)
+        self.selector.register(r, selectors.EVENT_READ, pid)
+        self.children[pid] = [r, time.time(), b'']
+        self.slots[pid] = slot
+        logger.info('started worker %s', pid)
+        return pid
+
+    def forget(self, pid):
+        r = self.children.pop(pid)[0]
+        self.slots.pop(pid, None)
+        self.selector.unregister(r)
+        os.close(r)
+
+    def read_health(self, pid):
+        child = self.children.get(pid)
+        if child is None:
+            return
+        try:
+            data = os.read(child[0], 65536)
+        except BlockingIOError:
+            return
+        child[1] = time.time()
+        lines = (child[2] + data).split(b'\n')
+        child[2] = lines.pop()
+        for line in lines:
+            logger.info('worker health: %s', line.decode('utf-8'))
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.children:
+                slot = self.slots[pid]
+                self.forget(pid)
+                if not self.stopping:
+                    self.schedule(slot, pid, status)
+
+    def schedule(self, slot, pid, status):
+        # 连续退出时按指数退避重新启动, 短时间内退出次数过多时停止master, 避免不断fork
+        now = time.time()
+        failures = self.failures[slot]
+        failures.append(now)
+        while failures[0] < now - self.FAILURE_WINDOW:
+            failures.popleft()
+        if len(failures) >= self.MAX_FAILURES:
+            logger.error('worker %s exited with status %s, %s times in %s seconds, stopping...', pid, status, len(failures), self.FAILURE_WINDOW)
+            self.failed = True
+            self.stopping = True
+            return
+        delay = min(self.RESPAWN_DELAY * 2 ** (len(failures) - 1), self.RESPAWN_MAX_DELAY)
+        logger.warning('worker %s exited with status %s, restarting in %s seconds...', pid, status, delay)
+        self.pending[slot] = now + delay
+
+    def respawn(self):
+        now = time.time()
+        for slot, at in list(self.pending.items()):
+            if at <= now:
+                del self.pending[slot]
+                self.spawn(slot)
+
+    def check_stuck(self):
+        # 超过3个周期没有报告状态的worker，认为已失去响应
+        deadline = time.time() - self.health_interval * 3
+        for pid, child in list(self.children.items()):
+            if child[1] < deadline:
+                logger.warning('worker %s stopped reporting health, killing...', pid)
+                child[1] = time.time()
+                os.kill(pid, signal.SIGKILL)
+
+    def restart(self):
+        logger.info('graceful restart...')
+        old = list(self.children.keys())
+        self.pending.clear()
+        for i in range(self.workers):
+            self.spawn(i)
+        for pid in old:
+            self.forget(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    def stop(self):
+        self.stopping = True
+        for pid in list(self.children.keys()):
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.shutdown_timeout + 5
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children.keys()):
+            os.kill(pid, signal.SIGKILL)
+            self.forget(pid)
+
+    def run(self):
+        def on_hup(signum, frame):
+            self.restarting = True
+        def on_term(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGHUP, on_hup)
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGINT, on_term)
+        logger.info('master %s starting %s workers at http://%s:%s...', os.getpid(), self.workers, self.host, self.port)
+        for i in range(self.workers):
+            self.spawn(i)
+        while not self.stopping:
+            for key, events in self.selector.select(timeout=1):
+                self.read_health(key.data)
+            if self.restarting:
+                self.restarting = False
+                self.restart()
+            self.reap()
+            self.respawn()
+            self.check_stuck()
+        self.stop()
+        logger.info('master %s stopped.', os.getpid())
+        if self.failed:
+            sys.exit(1)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Session store. Verified sessions are kept in a store keyed by session id, so
+authenticating a request is a lookup instead of verifying and decoding the cookie.
+Revoked sessions are recorded in the same store, so with more than one worker
+process the store must be shared by them.
+'''
+
+__author__ = 'hpt'
+
+import asyncio, logging
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class SessionStore(object):
+    '''
+    Interface of session stores, a session is a dict. Implement it for an external
+    store shared by processes and install it by set_store().
+    '''
+    async def get(self, sid):
+        'return session and extend its expiration, or None.'
+        raise NotImplementedError()
+
+    async def set(self, sid, session):
+        raise NotImplementedError()
+
+    async def delete(self, sid):
+        raise NotImplementedError()
+
+    async def revoke(self, key, ttl):
+        'mark key (a session id, or a user and passwd version) as revoked for ttl seconds.'
+        raise NotImplementedError()
+
+    async def revoked(self, key):
+        'return True if key is revoked.'
+        raise NotImplementedError()
+
+    async def purge(self):
+        'remove expired sessions, return number of removed sessions.'
+        return 0
+
+    def stats(self):
+        return dict()
+
+class MemorySessionStore(SessionStore):
+    '''
+    In-process store, at most maxsize sessions, a session expires after ttl seconds without access.
+    Not shared by processes, use it with one worker only.
+    '''
+    def __init__(self, maxsize=100000, ttl=3600, revoked_maxsize=10000):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._revoked = LRUCache(maxsize=revoked_maxsize)
+        self.created = 0
+        self.purged = 0
+
+    async def get(self, sid):
+        session = self._cache.get(sid)
+        if session is not None:
+            self._cache.set(sid, session) # 滑动过期: 每次访问重新计算过期时间
+        return session
+
+    async def set(self, sid, session):
+        self._cache.set(sid, session)
+        self.created += 1
+
+    async def delete(self, sid):
+        self._cache.delete(sid)
+
+    async def revoke(self, key, ttl):
+        self._revoked.set(key, True, ttl)
+
+    async def revoked(self, key):
+        return self._revoked.get(key, False)
+
+    async def purge(self):
+        self._revoked.purge()
+        n = self._cache.purge()
+        self.purged += n
+        return n
+
+    def stats(self):
+        return dict(self._cache.stats(), active=len(self._cache), revoked=len(self._revoked), created=self.created, purged=self.purged)
+
+store = MemorySessionStore()
+
+def set_store(s):
+    global store
+    store = s
+
+# 定期清除过期的session, 由app在启动时创建任务
+async def purge_expired(interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        n = await store.purge()
+        if n:
+            logger.info('purged %s expired sessions, stats: %s', n, store.stats())
@@ -3,11 +3,25 @@
 
 
 # orm TEST
-from orm import Model, StringField, IntegerField, FloatField, create_pool, select, execute
-import asyncio
+from orm import Model, StringField, IntegerField, FloatField, create_pool, close_pool, select, select_iter, execute
+import asyncio, logging, sys, os, tempfile, sqlite3
+logging.basicConfig(level=logging.INFO)
+
+# python test.py sqlite 使用临时的sqlite数据库, 不需要MySQL
+# python test.py replicas 使用三个sqlite数据库作为主库和两个副本, 测试读写分离
+DRIVER = sys.argv[1] if len(sys.argv) > 1 else 'mysql'
+_pool_created = False
 
 async def get_pool(loop):
-    return await create_pool(host='127.0.0.1', port=3306, user='root', password='123456', db='test_db', loop=loop)
+    global _pool_created
+    if _pool_created:
+        return
+    _pool_created = True
+    if DRIVER == 'sqlite':
+        await create_pool(driver='sqlite', db=os.path.join(tempfile.mkdtemp(), 'test.db'), loop=loop)
+        await execute('create table `users` (`id` bigint primary key, `name` varchar(100))', [])
+        return
+    await create_pool(host='127.0.0.1', port=3306, user='root', password='123456', db='test_db', loop=loop)
 
 class User(Model):
     __table__ = 'users'
@@ -59,7 +73,66 @@ async def test_removeItem(loop, item):
     await User.removeItem(item)
     print('test_remove----table[id=%d] removed.' % item.id)
 
-if __name__ == '__main__':
+# 读写分离测试: 每个数据库中id为1的用户名为库名, 由查询结果判断读的是哪个库
+def create_databases(names):
+    d = tempfile.mkdtemp()
+    paths = []
+    for name in names:
+        path = os.path.join(d, '%s.db' % name)
+        conn = sqlite3.connect(path)
+        conn.execute('create table `users` (`id` bigint primary key, `name` varchar(100))')
+        conn.execute('insert into `users` values (1, ?)', (name,))
+        conn.commit()
+        conn.close()
+        paths.append(path)
+    return paths
+
+async def read_name():
+    rs = await select('select `name` from `users` where `id`=?', [1])
+    return rs[0]['name']
+
+async def test_round_robin(loop, paths):
+    print('\n')
+    await create_pool(driver='sqlite', db=paths[0], replicas=[dict(db=p) for p in paths[1:]], loop=loop)
+    names = [(await read_name()) for i in range(4)]
+    assert set(names) == set(['replica1', 'replica2']) and names[0] == names[2] and names[1] == names[3], names
+    print('test_round_robin----reads: %s' % names)
+    await close_pool()
+
+async def test_least_busy(loop, paths):
+    print('\n')
+    await create_pool(driver='sqlite', db=paths[0], replicas=[dict(db=p) for p in paths[1:]], replica_select='least_busy', loop=loop)
+    # 迭代未结束时占用一个副本的连接, 后续的读选择另一个副本
+    it = select_iter('select `name` from `users`', [], batch=1)
+    busy = (await it.__anext__())[0]['name']
+    names = [(await read_name()) for i in range(3)]
+    await it.aclose()
+    assert busy == 'replica1' and names == ['replica2'] * 3, (busy, names)
+    print('test_least_busy----busy: %s, reads: %s' % (busy, names))
+    await close_pool()
+
+async def test_read_your_writes(loop, paths):
+    print('\n')
+    await create_pool(driver='sqlite', db=paths[0], replicas=[dict(db=p) for p in paths[1:]], loop=loop)
+    async def write_then_read():
+        before = await read_name()
+        await execute('update `users` set `name`=? where `id`=?', ['primary, updated', 1])
+        return before, (await read_name()), (await read_name())
+    # 写过数据的task后续从主库读, 其他task仍从副本读
+    before, after, again = await asyncio.ensure_future(write_then_read())
+    other = await asyncio.ensure_future(read_name())
+    assert before.startswith('replica') and after == again == 'primary, updated' and other.startswith('replica'), (before, after, again, other)
+    print('test_read_your_writes----before: %s, after: %s, other task: %s' % (before, after, other))
+    await close_pool()
+
+if __name__ == '__main__' and DRIVER == 'replicas':
+    paths = create_databases(['primary', 'replica1', 'replica2'])
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test_round_robin(loop, paths))
+    loop.run_until_complete(test_least_busy(loop, paths))
+    loop.run_until_complete(test_read_your_writes(loop, paths))
+    loop.close()
+elif __name__ == '__main__':
     tom = User(id=11, name='tom')
     loop = asyncio.get_event_loop() # 获取消息循环对象
     loop.run_until_complete(test_findAll(loop))
@@ -73,6 +146,7 @@ if __name__ == '__main__':
     loop.run_until_complete(test_find(loop, 3))
     loop.run_until_complete(test_update(loop, 3, name='Mike'))
     loop.run_until_complete(test_findAll(loop))
+    loop.run_until_complete(close_pool())
     loop.close()
 
 